@@ -0,0 +1,159 @@
+"""
+Compact store of account xpubs from DB exports: sorted 4 byte account indexes followed by the 78 byte serialized keys,
+looked up by binary search. Exports are streamed into the store once and kept as a file under ./cache/account_keys/,
+which later runs memory-map instead of parsing the export again. Exports larger than memory are sorted in runs that are
+merged into the store.
+"""
+from .cache import ACCOUNT_KEYS_PATH
+from pycoin.encoding import EncodingError, a2b_hashed_base58, b2a_hashed_base58
+import bisect
+import csv
+import heapq
+import mmap
+import os
+import os.path
+import re
+import shutil
+import struct
+import tempfile
+
+MAGIC = b'MSRKEYS1'
+HEADER = struct.Struct('>8sQ')
+INDEX = struct.Struct('>I')
+KEY_SIZE = 78
+ENTRY = struct.Struct('>I78s')  # big endian, so entries sort by account index
+RUN_SIZE = 1000000  # entries sorted in memory at once, ~90MB of entries
+JSON_ENTRY = re.compile(r'"?(\d+)"?\s*:\s*"(\w+)"')
+
+
+def iter_json_export(path, chunk_size=1 << 20):
+	"""streams (account index, xpub) from a flat json object {"index": "xpub", ...} without loading it whole"""
+	with open(path) as fp:
+		tail = ''
+		while True:
+			chunk = fp.read(chunk_size)
+			buffer = tail + chunk
+			end = 0
+			for match in JSON_ENTRY.finditer(buffer):
+				yield int(match.group(1)), match.group(2)
+				end = match.end()
+			tail = buffer[end:]
+			if not chunk:
+				break
+
+
+def iter_csv_export(path):
+	"""streams (account index, xpub) from csv rows index,xpub, a header row is skipped"""
+	with open(path) as fp:
+		for row in csv.reader(fp):
+			if len(row) >= 2 and row[0].strip().isdigit():
+				yield int(row[0]), row[1].strip()
+
+
+def _entry(account_index, hwif):
+	try:
+		key = a2b_hashed_base58(hwif)
+	except EncodingError as err:
+		raise ValueError('account %d: %s is not a base58 key (%s)' % (account_index, hwif, err))
+	if len(key) != KEY_SIZE:
+		raise ValueError('account %d: %s decodes to %d bytes, not the %d of an xpub' % (account_index, hwif, len(key), KEY_SIZE))
+	return ENTRY.pack(account_index, key)
+
+
+def _read_run(path):
+	with open(path, 'rb') as fp:
+		while True:
+			entry = fp.read(ENTRY.size)
+			if len(entry) < ENTRY.size:
+				return
+			yield entry
+
+
+def _write_run(directory, number, run):
+	run.sort()
+	path = os.path.join(directory, '%d.run' % number)
+	with open(path, 'wb') as fp:
+		fp.write(b''.join(run))
+	return path
+
+
+def write_store(fp, entries, run_size=RUN_SIZE):
+	"""writes (account index, xpub) entries given in any order as store to fp, raises ValueError on keys that aren't xpubs"""
+	directory = tempfile.mkdtemp(prefix='account-keys-', dir=os.path.dirname(getattr(fp, 'name', '')) or None)
+	try:
+		run_paths, run, count = [], [], 0
+		for account_index, hwif in entries:
+			run.append(_entry(account_index, hwif))
+			count += 1
+			if len(run) == run_size:
+				run_paths.append(_write_run(directory, len(run_paths), run))
+				run = []
+		if run_paths:
+			if run:
+				run_paths.append(_write_run(directory, len(run_paths), run))
+			sorted_entries = heapq.merge(*[_read_run(path) for path in run_paths])
+		else:
+			sorted_entries = sorted(run)
+
+		fp.write(HEADER.pack(MAGIC, count))
+		with tempfile.TemporaryFile(dir=directory) as keys:  # the keys section follows all indexes
+			for entry in sorted_entries:
+				fp.write(entry[:INDEX.size])
+				keys.write(entry[INDEX.size:])
+			keys.seek(0)
+			shutil.copyfileobj(keys, fp)
+	finally:
+		shutil.rmtree(directory)
+
+
+class PackedAccountKeys(object):
+	"""read-only account index -> xpub over store bytes or a memory-mapped store file"""
+
+	@classmethod
+	def from_export(cls, path, cache_path=ACCOUNT_KEYS_PATH):
+		"""
+		Streams a .json or .csv export into a store file named by the export's name, size and mtime, or maps the store
+		file of an earlier run.
+		"""
+		stat = os.stat(path)
+		store_path = os.path.join(cache_path, '%s-%d-%d.keys' % (os.path.basename(path), stat.st_size, int(stat.st_mtime)))
+		if not os.path.exists(store_path):
+			if not os.path.exists(cache_path):
+				os.makedirs(cache_path)
+			entries = iter_csv_export(path) if path.endswith('.csv') else iter_json_export(path)
+			try:
+				with open(store_path + '.part', 'wb') as fp:
+					write_store(fp, entries)
+			except:
+				if os.path.exists(store_path + '.part'):
+					os.remove(store_path + '.part')
+				raise
+			os.rename(store_path + '.part', store_path)
+		with open(store_path, 'rb') as fp:
+			return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+	def __init__(self, data):
+		self.data = data
+		magic, self.count = HEADER.unpack_from(data, 0)
+		if magic != MAGIC:
+			raise ValueError('not an account keys store')
+		self.keys_offset = HEADER.size + self.count * INDEX.size
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, position):
+		""":returns account index at position, for bisect"""
+		return INDEX.unpack_from(self.data, HEADER.size + position * INDEX.size)[0]
+
+	def get(self, account_index):
+		""":returns xpub of account_index or None"""
+		position = bisect.bisect_left(self, account_index)
+		if position == self.count or self[position] != account_index:
+			return None
+		offset = self.keys_offset + position * KEY_SIZE
+		return b2a_hashed_base58(self.data[offset:offset + KEY_SIZE])
+
+	def __iter__(self):
+		for position in range(self.count):
+			yield self[position]
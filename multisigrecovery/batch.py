@@ -4,18 +4,37 @@ from pycoin.merkle import merkle
 from pycoin.encoding import double_sha256
 from pycoin.convention import tx_fee, satoshi_to_mbtc
 from pycoin.networks import address_prefix_for_netcode
-from pycoin.services import spendables_for_address, get_tx_db
 
+from multiprocessing.pool import ThreadPool
+import collections
 import json
-import multisigcore
-import multisigcore.oracle
-import sys
-from . import cosign
+import multiprocessing
+from .signer import Signer
+from .derivation import derivation_cache
+from .merkletree import MerkleTree
+from .metrics import CPU, DISK, NETWORK, metrics
+
+SIGN_WINDOW = 250  # txs per worker held in memory at once while signing
 
 def full_leaf_path(account_path, leaf_path):
 	return '/%s/%s' % (account_path.strip('/'), leaf_path.strip('/'))
 
 
+def merkle_root(tx_hashes):
+	return b2h_rev(merkle(sorted(tx_hashes), double_sha256)) if tx_hashes else None
+
+
+def _windows(iterable, size):
+	window = []
+	for item in iterable:
+		window.append(item)
+		if len(window) == size:
+			yield window
+			window = []
+	if window:
+		yield window
+
+
 class Batch(object):
 
 	@classmethod
@@ -33,7 +52,8 @@ class Batch(object):
 		self.original_master_xpubs = original_master_xpubs
 		self.destination_master_xpubs = destination_master_xpubs
 		self.batchable_txs = batchable_txs
-		self.merkle_root = merkle_root
+		self.merkle_tree = None  # built on first use, updated by sign()
+		self.merkle_root = merkle_root  # as stated by a loaded file, new batches get theirs when written or signed
 		self.total_out = total_out or sum([batchable_tx.total_out() for batchable_tx in batchable_txs])
 		self.checksum = checksum or -1  # todo - checksum
 
@@ -41,23 +61,121 @@ class Batch(object):
 		# shouldn't get called without transactions
 		if not len(self.batchable_txs):
 			return None
-		else:
-			return b2h_rev(merkle(sorted([tx.hash() for tx in self.batchable_txs]), double_sha256))
+		if self.merkle_tree is None:
+			self.merkle_tree = MerkleTree([tx.hash() for tx in self.batchable_txs])
+		return self.merkle_tree.root()
+
+	def merkle_proof(self, tx_id):
+		""":returns inclusion proof of one tx, check with merkletree.verify_merkle_proof(**proof)"""
+		self.build_merkle_root()
+		return {'tx_id': tx_id, 'path': self.merkle_tree.proof(h2b_rev(tx_id)), 'merkle_root': self.merkle_tree.root()}
 
+	def export_merkle_proofs(self, file_path, tx_ids=None):
+		"""writes one json proof per line for tx_ids, or for all txs"""
+		with open(file_path, 'w') as fp:
+			for tx_id in tx_ids or (tx.id() for tx in self.batchable_txs):
+				fp.write(json.dumps(self.merkle_proof(tx_id)) + '\n')
+		print "save %s" % file_path
+
+
+	def get_tx(self, tx_id):
+		""":returns BatchableTx with tx_id or None, packed batches look it up in their index without reading other txs"""
+		if hasattr(self.batchable_txs, 'get'):
+			return self.batchable_txs.get(tx_id)
+		for batchable_tx in self.batchable_txs:
+			if batchable_tx.id() == tx_id:
+				return batchable_tx
 
 	def to_file(self, file_path):
 		data = {
 			'header': {
 				'original_master_xpubs': self.original_master_xpubs, 'destination_master_xpubs': self.destination_master_xpubs,
-				'merkle_root': self.merkle_root, 'total_out': self.total_out, 'checksum': self.checksum
+				'merkle_root': self.build_merkle_root() if self.merkle_root is None else self.merkle_root,
+				'total_out': self.total_out, 'checksum': self.checksum,
 			},
 			'txs': [batchable_tx.as_dict() for batchable_tx in self.batchable_txs],
 		}
-		with open(file_path, 'w') as fp:
-			print "save %s" % file_path
-			json.dump(data, fp)
+		with metrics.timer('serialize', kind=DISK):
+			with open(file_path, 'w') as fp:
+				print "save %s" % file_path
+				json.dump(data, fp)
+
+	def prefetch_unspents(self, provider, workers=8):
+		"""
+		:returns {(previous hash, previous index): TxOut} for all inputs in the batch. Every funding tx is read once, from the
+		local tx cache if there, otherwise fetched from provider by workers threads and added to the cache. Only the spent
+		outputs are kept in memory.
+		"""
+		from .txdb import PackedTxDb
+		spent_indexes = collections.defaultdict(set)
+		for tx in self.batchable_txs:
+			for tx_in in tx.txs_in:
+				spent_indexes[tx_in.previous_hash].add(tx_in.previous_index)
+		tx_db = PackedTxDb()
+		unspents = {}
+
+		def keep(funding_tx):
+			for previous_index in spent_indexes[funding_tx.hash()]:
+				unspents[(funding_tx.hash(), previous_index)] = funding_tx.txs_out[previous_index]
 
-	def validate(self, provider=None):
+		missing = []
+		for previous_hash in spent_indexes:
+			funding_tx = tx_db.get(previous_hash)
+			if funding_tx is None:
+				missing.append(previous_hash)
+			else:
+				keep(funding_tx)
+		print "Fetching %d of %d funding txs, the rest are in local cache..." % (len(missing), len(spent_indexes))
+
+		def fetch(previous_hash):
+			with metrics.timer('get_tx', kind=NETWORK):
+				funding_tx = provider.get_tx(previous_hash)
+			if funding_tx is None or funding_tx.hash() != previous_hash:
+				raise ValueError("funding tx %s not found" % b2h_rev(previous_hash))
+			tx_db.put(funding_tx)
+			return funding_tx
+
+		pool = ThreadPool(max(1, workers))
+		progress = metrics.progress('funding_txs', total=len(missing), unit='txs')
+		try:
+			for funding_tx in pool.imap_unordered(fetch, missing):
+				keep(funding_tx)
+				progress.update()
+		finally:
+			pool.close()
+			pool.join()
+			tx_db.close()
+			progress.close()
+		return unspents
+
+	@metrics.timed('check_signatures')
+	def check_signatures(self, unspents, processes=1):
+		"""
+		Checks signatures of all txs against unspents, in windows checked by a pool of processes. Inputs already checked in
+		earlier runs are looked up in the signature cache, so after cosigning only new signatures are verified.
+		:returns {tx id: number of inputs with missing or bad signatures}
+		"""
+		from .signatures import SignatureCache, bad_signature_counts
+		cache = SignatureCache()
+		pool = multiprocessing.Pool(processes) if processes > 1 else None
+		counts = {}
+		try:
+			for window in _windows(self.batchable_txs, SIGN_WINDOW * processes):
+				for tx in window:
+					tx.unspents = [unspents[(tx_in.previous_hash, tx_in.previous_index)] for tx_in in tx.txs_in]
+				with metrics.timer('verify', kind=CPU):
+					counts.update(bad_signature_counts(window, cache, pool=pool))
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+		return counts
+
+	@metrics.timed('validate')
+	def validate(self, provider=None, workers=8, processes=1):
+		""":param workers: threads fetching funding txs, :param processes: processes checking signatures (online only)"""
+		if not self.merkle_root:
+			raise ValueError("batch header states no merkle_root")
 		if self.merkle_root != self.build_merkle_root():
 			raise ValueError("calculated merkle_root %s does not match stated merkle_root %s from header" % (self.build_merkle_root(), self.merkle_root))
 
@@ -66,6 +184,8 @@ class Batch(object):
 			print "Doing full, online validation."
 			self.total_in = 0
 			self.total_fee = 0
+			unspents = self.prefetch_unspents(provider, workers=workers)
+			bad_signatures = self.check_signatures(unspents, processes=processes)
 		else:
 			print "Doing limited, offline validation."
 
@@ -75,10 +195,7 @@ class Batch(object):
 			print "- Total out", tx.total_out()
 			self.total_out += tx.total_out()
 			if provider:
-				print "Fetching %d UTXO..." % len(tx.txs_in)
-				for idx, tx_in in enumerate(tx.txs_in):
-					unspent_tx = provider.get_tx(tx_in.previous_hash)
-					tx.unspents.append(unspent_tx.txs_out[tx_in.previous_index])
+				tx.unspents = [unspents[(tx_in.previous_hash, tx_in.previous_index)] for tx_in in tx.txs_in]
 
 				print "- Total in", tx.total_in()
 				self.total_in += tx.total_in()
@@ -91,23 +208,71 @@ class Batch(object):
 				if tx.fee() > 100000 and tx.fee() > 2 * tx_fee.recommended_fee_for_tx(tx):
 					raise ValueError("Very high fee in transaction %s" % tx.id())
 				print "- Fee Percent", (tx.fee() * 100.00 / tx.total_out())
-				print "- Bad Signatures", tx.bad_signature_count(), "of", len(tx.txs_in)
+				print "- Bad Signatures", bad_signatures[tx.id()], "of", len(tx.txs_in)
 
-	def sign(self, master_private_key):  # todo - test to see if this needs to be cached to FS when signing 100k txs
-		for tx_i, batchable_tx in enumerate(self.batchable_txs):
-			try:
-				cosign(batchable_tx, keys=[master_private_key.subkey_for_path(path.strip('/')) for path in batchable_tx.input_paths])
-				print 'signed: %s' % batchable_tx.id()
-			except Exception as err:
-				print '! could not sign tx %s, skipping' % batchable_tx.id(), err
+	@metrics.timed('signing')
+	def sign(self, master_private_key, workers=1, writer=None):
+		"""
+		Signs txs in place, or passes every tx in order to writer (see batchfile.BatchWriter) so a streamed batch is signed
+		with bounded memory. With workers > 1 txs are signed in chunks by a process pool.
+		"""
+		pool = multiprocessing.Pool(workers) if workers > 1 else None
+		signer = Signer(master_private_key)  # keys and redeem scripts are reused across txs
+		signed_txs = []
+		changed_hashes = []
+		progress = metrics.progress('signing', total=len(self.batchable_txs), unit='txs')
+		try:
+			for window in _windows(self.batchable_txs, SIGN_WINDOW * workers):
+				unsigned_hashes = [batchable_tx.hash() for batchable_tx in window]  # serial signing changes txs in place
+				with metrics.timer('sign', kind=CPU):
+					signed_window = self.__sign_window(window, signer, pool, workers)
+				for batchable_tx, unsigned_hash, (signed_tx, error) in zip(window, unsigned_hashes, signed_window):
+					if error is None:
+						changed_hashes.append((unsigned_hash, signed_tx.hash()))
+						batchable_tx = signed_tx
+						print 'signed: %s' % signed_tx.id()
+					else:
+						print '! could not sign tx %s, skipping' % batchable_tx.id(), error
+					if writer is not None:
+						writer.write(batchable_tx)
+					else:
+						signed_txs.append(batchable_tx)
+					metrics.count('txs_signed' if error is None else 'txs_not_signed')
+					progress.update()
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+			progress.close()
+		if writer is not None:
+			self.merkle_root = writer.build_merkle_root()
+		else:
+			self.batchable_txs = signed_txs
+			if self.merkle_tree is not None:
+				self.merkle_tree.replace(changed_hashes)
+			self.merkle_root = self.build_merkle_root()
+		print 'derivation cache: %s' % derivation_cache
 
-	def broadcast(self, provider):  # todo - broadcasting status will need to be cached to FS + checking blockchain until all txs pushed
-		for batchable_tx in self.batchable_txs:
-			try:
-				provider.send_tx(batchable_tx)
-				print 'broadcasted %s %s' % (batchable_tx.id(), batchable_tx.as_hex())
-			except Exception, err:
-				sys.stderr.write("! tx %s failed to propagate [%s] (%s)\n" %(batchable_tx.id(), batchable_tx.as_hex(), str(err)))
+	@staticmethod
+	def __sign_window(window, signer, pool, workers):
+		if pool is None or len(window) == 1:
+			return [_sign(batchable_tx, signer) for batchable_tx in window]
+		chunk_size = max(1, len(window) // (workers * 4))  # a few chunks per worker to even out load
+		master_key_hwif = signer.master_private_key.hwif(as_private=True)
+		chunks = [(master_key_hwif, [tx.as_dict() for tx in window[i:i + chunk_size]]) for i in range(0, len(window), chunk_size)]
+		signed_chunks = pool.map(_sign_chunk, chunks)
+		derivation_cache.hits += sum(hits for chunk, hits, misses in signed_chunks)
+		derivation_cache.misses += sum(misses for chunk, hits, misses in signed_chunks)
+		return [(BatchableTx.from_dict(tx_dict) if error is None else None, error) for chunk, hits, misses in signed_chunks for tx_dict, error in chunk]
+
+	def broadcast(self, provider, journal_path=None, connections=1, rate=None):
+		"""
+		Pushes txs, journaling each tx's state to journal_path so a re-run skips confirmed txs and re-checks sent ones.
+		:param rate: max requests per second to provider, unlimited if None
+		:returns counts of txs per journal state
+		"""
+		from .broadcast import Broadcaster  # offline commands (cosign, convert, ...) don't load network modules
+		return Broadcaster(provider, journal_path=journal_path, connections=connections, rate=rate).run(self.batchable_txs)
 
 	def __repr__(self):
 		return "Batch(%s)" % str(self.merkle_root)
@@ -118,6 +283,32 @@ class Batch(object):
 			self.total_fee == other.total_fee and self.checksum == other.checksum and len(self.batchable_txs) == len(other.batchable_txs)
 
 
+def _sign(batchable_tx, signer):
+	""":returns (signed tx, None) or (None, error)"""
+	try:
+		signer.sign(batchable_tx)
+		return batchable_tx, None
+	except Exception as err:
+		return None, err
+
+
+_signers = {}  # Signer per master key in pool worker processes, kept across chunks
+
+
+def _sign_chunk(args):
+	"""process pool worker for Batch.sign, txs travel as dicts both ways. Also returns the chunk's derivation cache hits/misses."""
+	master_key_hwif, tx_dicts = args
+	if master_key_hwif not in _signers:
+		from multisigcore.hierarchy import MasterKey
+		_signers[master_key_hwif] = Signer(MasterKey.from_hwif(master_key_hwif))
+	hits, misses = derivation_cache.hits, derivation_cache.misses
+	results = []
+	for tx_dict in tx_dicts:
+		signed_tx, error = _sign(BatchableTx.from_dict(tx_dict), _signers[master_key_hwif])
+		results.append((signed_tx.as_dict(), None) if error is None else (None, str(error)))
+	return results, derivation_cache.hits - hits, derivation_cache.misses - misses
+
+
 class BatchableTx(Tx):
 
 	@classmethod
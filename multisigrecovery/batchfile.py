@@ -0,0 +1,276 @@
+from .batch import Batch, BatchableTx, merkle_root
+from .metrics import DISK, metrics
+from pycoin.serialize import b2h, h2b_rev
+import bisect
+import json
+import mmap
+import os
+import struct
+
+STREAM_FORMAT = 'multisig-recovery-stream/1'
+STREAM_PREFIX = '{"format": "%s"' % STREAM_FORMAT
+PACKED_MAGIC = b'MSRBATv1'
+FORMATS = ['stream', 'json', 'packed']
+
+
+def detect_format(path):
+	with open(path, 'rb') as fp:
+		start = fp.read(len(STREAM_PREFIX))
+	if start.startswith(PACKED_MAGIC):
+		return 'packed'
+	return 'stream' if start == STREAM_PREFIX else 'json'
+
+
+def load_batch(path):
+	"""Batch from a file of any supported format. Streamed and packed batches are read lazily, txs are not held in memory."""
+	format = detect_format(path)
+	if format in ('stream', 'packed'):
+		reader = BatchReader(path) if format == 'stream' else PackedBatchReader(path)
+		return Batch(
+			original_master_xpubs=reader.header['original_master_xpubs'], destination_master_xpubs=reader.header['destination_master_xpubs'],
+			merkle_root=reader.trailer['merkle_root'], total_out=reader.trailer['total_out'], checksum=reader.header['checksum'],
+			batchable_txs=reader,
+		)
+	return Batch.from_file(path)
+
+
+def batch_writer(path, format, original_master_xpubs, destination_master_xpubs, checksum=-1):
+	writer_class = {'stream': BatchWriter, 'packed': PackedBatchWriter}[format]
+	return writer_class(path, original_master_xpubs, destination_master_xpubs, checksum=checksum)
+
+
+def save_batch(batch, path, format='json'):
+	if format == 'json':
+		batch.to_file(path)
+	else:
+		with batch_writer(path, format, batch.original_master_xpubs, batch.destination_master_xpubs, checksum=batch.checksum) as writer:
+			for batchable_tx in batch.batchable_txs:
+				writer.write(batchable_tx)
+
+
+class BatchReader(object):
+	"""
+	Lazy, re-iterable sequence of BatchableTx over a streamed batch file:
+		{"format": ..., "header": {xpubs, checksum}}
+		{"bytes": ..., "input_paths": [...], "output_paths": [...]}   one line per tx
+		{"trailer": {merkle_root, total_out, count}}
+	Only the header and trailer lines are read when opened.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as fp:
+			self.header = json.loads(fp.readline())['header']
+			self.trailer = json.loads(self.__last_line(fp))['trailer']
+
+	@staticmethod
+	def __last_line(fp, block_size=4096):
+		fp.seek(0, os.SEEK_END)
+		end = position = fp.tell()
+		tail = b''
+		while position and tail.count(b'\n') < 2:
+			position = max(0, position - block_size)
+			fp.seek(position)
+			tail = fp.read(end - position)
+		return tail.rstrip(b'\n').split(b'\n')[-1]
+
+	def __iter__(self):
+		with open(self.path, 'rb') as fp:
+			fp.readline()  # header
+			for line in fp:
+				record = json.loads(line)
+				if 'trailer' in record:
+					break
+				yield BatchableTx.from_dict(record)
+
+	def __len__(self):
+		return self.trailer['count']
+
+
+class BatchWriter(object):
+	"""
+	Appends txs to a streamed batch file as they are produced, keeping only tx hashes in memory for the merkle root.
+	Writes go to <path>.part which is renamed into place by close(), so an interrupted run never leaves a truncated batch.
+	"""
+
+	def __init__(self, path, original_master_xpubs, destination_master_xpubs, checksum=-1):
+		self.path = path
+		self.tx_hashes = []
+		self.total_out = 0
+		self.fp = open(path + '.part', 'wb')
+		header = {'original_master_xpubs': original_master_xpubs, 'destination_master_xpubs': destination_master_xpubs, 'checksum': checksum}
+		self.fp.write('%s, "header": %s}\n' % (STREAM_PREFIX, json.dumps(header)))
+
+	@metrics.timed('serialize', kind=DISK)
+	def write(self, batchable_tx):
+		self.fp.write(json.dumps(batchable_tx.as_dict()) + '\n')
+		self.tx_hashes.append(batchable_tx.hash())
+		self.total_out += batchable_tx.total_out()
+
+	def build_merkle_root(self):
+		return merkle_root(self.tx_hashes)
+
+	def close(self):
+		trailer = {'merkle_root': self.build_merkle_root(), 'total_out': self.total_out, 'count': len(self.tx_hashes)}
+		self.fp.write(json.dumps({'trailer': trailer}) + '\n')
+		self.fp.close()
+		os.rename(self.path + '.part', self.path)
+		print "save %s" % self.path
+
+	def abort(self):
+		self.fp.close()
+		os.remove(self.path + '.part')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+
+class PackedBatchReader(object):
+	"""
+	Memory-mapped binary batch:
+		magic
+		records: (record length, tx length, tx bytes incl. unspents, input paths, output paths), strings length-prefixed
+		header: length-prefixed json {xpubs, checksum, merkle_root, total_out, count}
+		index: (tx hash, record offset) per tx, sorted by tx hash
+		footer: (header offset, index offset, count), magic
+	get(tx_id) binary searches the index and parses a single record.
+	"""
+
+	INDEX_ENTRY = struct.Struct('>32sQ')
+	FOOTER = struct.Struct('>QQI8s')
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as fp:
+			self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		header_offset, self.index_offset, self.count, magic = self.FOOTER.unpack_from(self.data, len(self.data) - self.FOOTER.size)
+		if magic != PACKED_MAGIC:
+			raise ValueError('%s is not a packed batch or is truncated' % path)
+		header_length, = struct.unpack_from('>I', self.data, header_offset)
+		self.header = json.loads(self.data[header_offset + 4:header_offset + 4 + header_length])
+		self.trailer = self.header  # same keys as the streamed trailer
+
+	def index_hash(self, position):
+		offset = self.index_offset + position * self.INDEX_ENTRY.size
+		return self.data[offset:offset + 32]
+
+	def get(self, tx_id):
+		""":returns BatchableTx with tx_id or None"""
+		tx_hash = h2b_rev(tx_id)
+		position = bisect.bisect_left(_IndexView(self), tx_hash)
+		if position < self.count and self.index_hash(position) == tx_hash:
+			offset = self.INDEX_ENTRY.unpack_from(self.data, self.index_offset + position * self.INDEX_ENTRY.size)[1]
+			return self.__parse_record(offset)[0]
+		return None
+
+	def __contains__(self, tx_id):
+		return self.get(tx_id) is not None
+
+	def __parse_record(self, offset):
+		""":returns (BatchableTx, offset of next record)"""
+		record_length, = struct.unpack_from('>I', self.data, offset)
+		end = offset + 4 + record_length
+		fields, position = [], offset + 4
+		while position < end:
+			field_length, = struct.unpack_from('>I', self.data, position)
+			fields.append(self.data[position + 4:position + 4 + field_length])
+			position += 4 + field_length
+		tx_bytes, input_paths, output_paths = fields
+		batchable_tx = BatchableTx.from_dict({
+			'bytes': b2h(tx_bytes), 'input_paths': _unpack_strings(input_paths), 'output_paths': _unpack_strings(output_paths),
+		})
+		return batchable_tx, end
+
+	def __iter__(self):
+		offset = len(PACKED_MAGIC)
+		for i in range(self.count):
+			batchable_tx, offset = self.__parse_record(offset)
+			yield batchable_tx
+
+	def __len__(self):
+		return self.count
+
+
+class _IndexView(object):
+	"""sequence of sorted tx hashes in the mmapped index, for bisect"""
+
+	def __init__(self, reader):
+		self.reader = reader
+
+	def __len__(self):
+		return self.reader.count
+
+	def __getitem__(self, position):
+		return self.reader.index_hash(position)
+
+
+def _pack_field(data):
+	return struct.pack('>I', len(data)) + data
+
+
+def _pack_strings(strings):
+	return struct.pack('>I', len(strings)) + b''.join(_pack_field(string.encode('utf8')) for string in strings)
+
+
+def _unpack_strings(data):
+	count, = struct.unpack_from('>I', data, 0)
+	strings, position = [], 4
+	for i in range(count):
+		length, = struct.unpack_from('>I', data, position)
+		strings.append(data[position + 4:position + 4 + length].decode('utf8'))
+		position += 4 + length
+	return strings
+
+
+class PackedBatchWriter(object):
+	"""Writes a PackedBatchReader file, records are appended as txs come, header and index are written by close()"""
+
+	def __init__(self, path, original_master_xpubs, destination_master_xpubs, checksum=-1):
+		self.path = path
+		self.header = {'original_master_xpubs': original_master_xpubs, 'destination_master_xpubs': destination_master_xpubs, 'checksum': checksum}
+		self.index = []  # (tx hash, record offset)
+		self.total_out = 0
+		self.fp = open(path + '.part', 'wb')
+		self.fp.write(PACKED_MAGIC)
+
+	@metrics.timed('serialize', kind=DISK)
+	def write(self, batchable_tx):
+		record = _pack_field(batchable_tx.as_bin(include_unspents=True)) + _pack_field(_pack_strings(batchable_tx.input_paths)) + \
+			_pack_field(_pack_strings(batchable_tx.output_paths))
+		self.index.append((batchable_tx.hash(), self.fp.tell()))
+		self.fp.write(_pack_field(record))
+		self.total_out += batchable_tx.total_out()
+
+	def build_merkle_root(self):
+		return merkle_root([tx_hash for tx_hash, offset in self.index])
+
+	def close(self):
+		self.header.update({'merkle_root': self.build_merkle_root(), 'total_out': self.total_out, 'count': len(self.index)})
+		header_offset = self.fp.tell()
+		self.fp.write(_pack_field(json.dumps(self.header).encode('utf8')))
+		index_offset = self.fp.tell()
+		for tx_hash, offset in sorted(self.index):
+			self.fp.write(PackedBatchReader.INDEX_ENTRY.pack(tx_hash, offset))
+		self.fp.write(PackedBatchReader.FOOTER.pack(header_offset, index_offset, len(self.index), PACKED_MAGIC))
+		self.fp.close()
+		os.rename(self.path + '.part', self.path)
+		print "save %s" % self.path
+
+	def abort(self):
+		self.fp.close()
+		os.remove(self.path + '.part')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
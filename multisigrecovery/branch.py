@@ -1,9 +1,14 @@
-from multisigcore.oracle import OracleUnknownKeychainException, Oracle, PersonalInformation
-import uuid
-import requests
+import collections
+import io
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 from multisigcore.hierarchy import MultisigAccount, AccountKey, MasterKey
 import json
 from pycoin.encoding import EncodingError
+from .derivation import derivation_cache
+from .accountkeys import PackedAccountKeys, write_store
+from .cache import ORACLE_KEYS_PATH
 
 class Branch(object):
 
@@ -11,6 +16,7 @@ class Branch(object):
 		self.account = lambda account_index: account_template(account_key_sources, account_index, provider)
 		self.master_key_names = [self.__key_source_string(key_source) for key_source in account_key_sources]
 		self.needs_oracle = bool(sum([isinstance(source, OracleAccountPubkeys) for source in account_key_sources]))
+		self.has_private_keys = any(isinstance(source, MasterKey) and source.is_private() for source in account_key_sources)
 
 		backup_account_path_template_map = {  # todo - this might become obsolete
 			self.bip32_account: '%d',
@@ -19,13 +25,41 @@ class Branch(object):
 		}
 		self.backup_account_path_template = backup_account_path_template_map[account_template]
 
+	def prefetch_oracle_keys(self, account_indexes, workers=8):
+		"""
+		Fetches oracle keys of many accounts concurrently into the oracle key cache, so later self.account() calls don't
+		wait on the oracle. Network errors and unknown keychains surface again when the account is used, other failures
+		are logged.
+		"""
+		if not self.needs_oracle:
+			return
+
+		from multisigcore.oracle import OracleUnknownKeychainException
+
+		def fetch(account_index):
+			try:
+				self.account(account_index)
+			except (IOError, OracleUnknownKeychainException):  # requests' errors are IOErrors
+				pass
+			except Exception as err:
+				sys.stderr.write("! account %d: oracle key not prefetched (%s: %s)\n" % (account_index, err.__class__.__name__, err))
+
+		pool = ThreadPool(max(1, workers))
+		try:
+			pool.map(fetch, account_indexes)
+		finally:
+			pool.close()
+			pool.join()
+
 	@property
 	def id(self):
 		return '_'.join(key_source_id[-10:] for key_source_id in sorted(self.master_key_names))
 
 	@staticmethod
 	def bip32_account(account_key_sources, account_index, provider, __hardened=False):
-		account_derivation = lambda source, i: source.bip32_account(i, hardened=source.is_private() and __hardened)
+		def account_derivation(source, i):
+			hardened = source.is_private() and __hardened
+			return derivation_cache.node(source, 'bip32_account/%d/%s' % (i, hardened), lambda: source.bip32_account(i, hardened=hardened))
 		account_keys = Branch._account_keys(account_key_sources, account_index, account_derivation)
 		account = MultisigAccount(keys=account_keys)
 		account._provider = provider
@@ -33,7 +67,7 @@ class Branch(object):
 
 	@staticmethod
 	def bip32_hardened_account(account_key_sources, account_index, provider):
-		return self.bip32_account(account_key_sources, account_index, provider, __hardened=True)
+		return Branch.bip32_account(account_key_sources, account_index, provider, __hardened=True)
 
 	@staticmethod
 	def bitoasis_v1_account(account_key_sources, account_index, provider):
@@ -45,8 +79,11 @@ class Branch(object):
 				public_pair=bip32key.public_pair() if not bip32key.is_private() else None,
 			)
 
-		legacy_local_account_key = to_legacy(account_key_sources[0].electrum_account(account_index))
-		legacy_backup_account_key = to_legacy(account_key_sources[1].bip32_account(account_index, hardened=False), is_backup_key=True)
+		local_source, backup_source = account_key_sources[0], account_key_sources[1]
+		local_account_key = derivation_cache.node(local_source, 'electrum_account/%d' % account_index, lambda: local_source.electrum_account(account_index))
+		backup_account_key = derivation_cache.node(backup_source, 'bip32_account/%d/False' % account_index, lambda: backup_source.bip32_account(account_index, hardened=False))
+		legacy_local_account_key = to_legacy(local_account_key)
+		legacy_backup_account_key = to_legacy(backup_account_key, is_backup_key=True)
 		cryptocorp_key = account_key_sources[2].get(account_index, [legacy_local_account_key, legacy_backup_account_key])
 		account_keys = [legacy_local_account_key, legacy_backup_account_key, cryptocorp_key]
 		account = MultisigAccount(account_keys, num_sigs=2, sort=False, complete=True)
@@ -81,7 +118,7 @@ class AccountPubkeys():
 	@staticmethod
 	def parse_string_to_account_key_source(string, register_oracle_accounts_file=False):
 
-		if '.json' in string:
+		if '.json' in string or string.endswith('.csv'):
 			return DictAccountPubkeys.from_file(string)
 
 		if 'digitaloracle' in string:
@@ -104,23 +141,51 @@ class AccountPubkeys():
 
 
 class DictAccountPubkeys(AccountPubkeys):
+	"""
+	Account xpubs of a DB export, kept as a compact sorted store (see accountkeys). Recently parsed keys are kept in an LRU,
+	account indexes may be ints or strings.
+	"""
+
+	LRU_SIZE = 1000
 
 	@classmethod
 	def from_file(cls, path):
-		""" :param path: path to json file containing "{account_number1: xpub1, ...}"""
-		with open(path) as fp:
-			return cls(json.load(fp))
+		""" :param path: path to json file containing "{account_number1: xpub1, ...}" or csv file of account_number,xpub rows"""
+		return cls(PackedAccountKeys.from_export(path))
 
 	def __init__(self, pubkeys_by_account_indexes):
+		""":param pubkeys_by_account_indexes: {account_number: xpub, ...} or PackedAccountKeys"""
+		if isinstance(pubkeys_by_account_indexes, dict):
+			store = io.BytesIO()
+			write_store(store, ((int(account_index), hwif) for account_index, hwif in pubkeys_by_account_indexes.items()))
+			pubkeys_by_account_indexes = PackedAccountKeys(store.getvalue())
 		self.pubkeys = pubkeys_by_account_indexes
+		self.lru = collections.OrderedDict()
+		self.lock = threading.Lock()
 
 	def get(self, account_index):
-		return AccountKey.from_hwif(self.pubkeys[account_index])
+		account_index = int(account_index)
+		with self.lock:
+			account_key = self.lru.pop(account_index, None)
+		if account_key is None:
+			hwif = self.pubkeys.get(account_index)
+			if hwif is None:
+				raise KeyError(account_index)
+			account_key = AccountKey.from_hwif(hwif)
+		with self.lock:
+			self.lru[account_index] = account_key
+			while len(self.lru) > self.LRU_SIZE:
+				self.lru.popitem(last=False)
+		return account_key
 
 
 class OracleAccountPubkeys(AccountPubkeys):
+	"""
+	Oracle keys of accounts, fetched over a pooled session with timeouts and retries (by a multisigcore Oracle class of
+	this source, see oracleclient.oracle_class) and kept in an on-disk cache keyed by the oracle url and the other keys.
+	"""
 
-	def __init__(self, base_cryptocorp_url, register_accounts_file=None):
+	def __init__(self, base_cryptocorp_url, register_accounts_file=None, timeout=30, retries=3, connections=8, key_cache_path=ORACLE_KEYS_PATH):
 		self.base_url = base_cryptocorp_url.strip('/') + '/'
 		self.register_accounts_file = register_accounts_file
 		if register_accounts_file:
@@ -128,10 +193,21 @@ class OracleAccountPubkeys(AccountPubkeys):
 				self.register = json.load(fp)
 		else:
 			self.register = None
-
-	def get(self, account_index, account_keys):  # todo - handle timeouts, bad connection
+		import multisigcore.oracle  # the oracle client and requests are only loaded by branches with an oracle key
+		from .oracleclient import OracleKeyCache, PooledRequests, oracle_class
+		self.requests = PooledRequests(timeout=timeout, retries=retries, connections=connections)
+		self.Oracle = oracle_class(multisigcore.oracle, self.requests)
+		self.key_cache = OracleKeyCache(key_cache_path)
+
+	def get(self, account_index, account_keys):
+		from multisigcore.oracle import OracleUnknownKeychainException, PersonalInformation
+		from .oracleclient import keychain_id
+		keychain = keychain_id(self.base_url, account_keys)
+		cached_hwif = self.key_cache.get(keychain)
+		if cached_hwif is not None:
+			return AccountKey.from_hwif(cached_hwif)
 		tmp_account = MultisigAccount(account_keys[:], complete=False)
-		tmp_oracle = Oracle(tmp_account, base_url=self.base_url, manager=self.register['manager'] if self.register is not None else None)
+		tmp_oracle = self.Oracle(tmp_account, base_url=self.base_url, manager=self.register['manager'] if self.register is not None else None)
 		try:
 			tmp_oracle.get()
 		except OracleUnknownKeychainException:
@@ -144,4 +220,6 @@ class OracleAccountPubkeys(AccountPubkeys):
 					raise ValueError('Account index %d missing in %s, could not register with CC' % (account_index, self.register_accounts_file))
 				tmp_oracle.create(self.register['parameters'], PersonalInformation(**personal_info_dict))
 		assert len(tmp_account.keys) == len(account_keys) + 1  # asserting that we fetched a missing key from oracle
-		return tmp_account.keys[-1]  # return the oracle key (last one)
\ No newline at end of file
+		oracle_key = tmp_account.keys[-1]  # return the oracle key (last one)
+		self.key_cache.put(keychain, oracle_key.hwif(as_private=False))
+		return oracle_key
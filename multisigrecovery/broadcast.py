@@ -0,0 +1,149 @@
+from .metrics import NETWORK, metrics
+from multiprocessing.pool import ThreadPool
+import json
+import os.path
+import sys
+import threading
+import time
+
+
+class BroadcastJournal(object):
+	"""
+	Append-only json lines log of broadcast state per tx, kept next to the batch file. The last line of a tx wins.
+	Without a path the journal is only kept in memory.
+	"""
+
+	PENDING = 'pending'
+	SENT = 'sent'
+	MEMPOOL = 'seen-in-mempool'
+	CONFIRMED = 'confirmed'
+	FAILED = 'failed'
+
+	def __init__(self, path=None):
+		self.path = path
+		self.states = {}
+		self.lock = threading.Lock()
+		if path and os.path.exists(path):
+			with open(path) as fp:
+				for line in fp:
+					try:
+						entry = json.loads(line)
+					except ValueError:  # torn last line after a crash
+						continue
+					self.states[entry['tx']] = entry['state']
+
+	def state(self, tx_id):
+		return self.states.get(tx_id, self.PENDING)
+
+	def record(self, tx_id, state, error=None):
+		entry = {'tx': tx_id, 'state': state, 'time': int(time.time())}
+		if error is not None:
+			entry['error'] = error
+		with self.lock:
+			self.states[tx_id] = state
+			if self.path:
+				with open(self.path, 'a') as fp:
+					fp.write(json.dumps(entry) + '\n')
+
+	def counts(self):
+		counts = {}
+		for state in self.states.values():
+			counts[state] = counts.get(state, 0) + 1
+		return counts
+
+
+class RateLimiter(object):
+	"""spaces calls from all threads at least 1/rate seconds apart, no limit for rate None"""
+
+	def __init__(self, rate=None):
+		self.interval = 1.0 / rate if rate else 0
+		self.next_time = 0
+		self.lock = threading.Lock()
+
+	def wait(self):
+		if not self.interval:
+			return
+		with self.lock:
+			now = time.time()
+			start = max(now, self.next_time)
+			self.next_time = start + self.interval
+		if start > now:
+			time.sleep(start - now)
+
+
+class Broadcaster(object):
+	"""
+	Pushes txs over several connections, rate limited, retrying transient errors with exponential backoff.
+	Txs journaled as sent or seen in mempool are checked against the chain before being pushed again, confirmed ones
+	are skipped, so an interrupted broadcast can simply be started again.
+	"""
+
+	def __init__(self, provider, journal_path=None, connections=1, rate=None, retries=5, backoff=1.0):
+		self.provider = provider
+		self.journal = BroadcastJournal(journal_path)
+		self.connections = max(1, connections)
+		self.rate_limiter = RateLimiter(rate)
+		self.retries = retries
+		self.backoff = backoff
+
+	@metrics.timed('broadcast')
+	def run(self, batchable_txs):
+		pool = ThreadPool(self.connections)
+		progress = metrics.progress('broadcast', total=len(batchable_txs), unit='txs')
+		try:
+			for state in pool.imap(self.broadcast_tx, batchable_txs, chunksize=1):
+				metrics.count('broadcast_%s' % state)
+				progress.update()
+		finally:
+			pool.close()
+			pool.join()
+			progress.close()
+		counts = self.journal.counts()
+		sys.stderr.write('broadcast journal: %s\n' % ', '.join('%s %d' % (state, count) for state, count in sorted(counts.items())))
+		return counts
+
+	def chain_state(self, batchable_tx):
+		""":returns CONFIRMED, MEMPOOL or None if the node doesn't know the tx"""
+		self.rate_limiter.wait()
+		try:
+			with metrics.timer('get_tx', kind=NETWORK):
+				tx = self.provider.get_tx(batchable_tx.hash())
+		except Exception:
+			return None
+		if tx is None:
+			return None
+		return BroadcastJournal.CONFIRMED if getattr(tx, 'confirmation_block_hash', None) else BroadcastJournal.MEMPOOL
+
+	def broadcast_tx(self, batchable_tx):
+		tx_id = batchable_tx.id()
+		state = self.journal.state(tx_id)
+		if state == BroadcastJournal.CONFIRMED:
+			return state
+		if state in (BroadcastJournal.SENT, BroadcastJournal.MEMPOOL):
+			seen = self.chain_state(batchable_tx)
+			if seen:
+				self.journal.record(tx_id, seen)
+				return seen
+		for attempt in range(self.retries + 1):
+			self.rate_limiter.wait()
+			try:
+				with metrics.timer('send_tx', kind=NETWORK):
+					self.provider.send_tx(batchable_tx)
+				self.journal.record(tx_id, BroadcastJournal.SENT)
+				print 'broadcasted %s %s' % (tx_id, batchable_tx.as_hex())
+				return BroadcastJournal.SENT
+			except ValueError as err:  # rejected by the node, maybe pushed by an earlier run that died before journaling
+				seen = self.chain_state(batchable_tx)
+				if seen:
+					self.journal.record(tx_id, seen)
+					return seen
+				return self.__failed(batchable_tx, err)
+			except Exception as err:
+				if attempt == self.retries:
+					return self.__failed(batchable_tx, err)
+				time.sleep(self.backoff * 2 ** attempt)
+
+	def __failed(self, batchable_tx, err):
+		self.journal.record(batchable_tx.id(), BroadcastJournal.FAILED, error=str(err))
+		sys.stderr.write("! tx %s failed to propagate [%s] (%s)\n" % (batchable_tx.id(), batchable_tx.as_hex(), str(err)))
+		return BroadcastJournal.FAILED
@@ -1,32 +1,114 @@
+import os
 import os.path
+import struct
+import zlib
+import collections
+import threading
 #import json
 import pickle
+from .metrics import DISK, metrics
+
+TX_PACK_PATH = './cache/txs.pack'  # txdb.PackedTxDb of funding txs, shared by recovery and validation
+SIGNATURE_CACHE_PATH = './cache/signatures.log'  # signatures.SignatureCache of checked tx inputs
+ORACLE_KEYS_PATH = './cache/oracle_keys.jsonl'  # oracleclient.OracleKeyCache, shared by all branches
+ACCOUNT_KEYS_PATH = './cache/account_keys/'  # accountkeys stores of account key exports
+UTXO_SNAPSHOTS_PATH = './cache/utxo_snapshots/'  # snapshot stores of utxo set exports
+TX_DB_PATH = './cache/tx_db'  # pycoin TxDb directory used before, see PackedTxDb.import_txs
+
 
 class Cache():
+	"""
+	Disk backed storage of recovery progress, one append-only log per record type:
+		./cache/<branch id>/<type>/records.log
+	Every record is framed as (key length, data length, crc32) + pickled key + pickled data. Offsets of the latest record
+	for each key are indexed in memory when the log is opened, so exists/count are O(1) and load is a single seek.
+	A record is only indexed once its frame is complete and its checksum matches, so a run killed mid-write loses at most
+	the record being written. Serialized bytes of recently used records are kept in a bounded LRU.
+	"""
 
 	ORIGINAL_ACCOUNT = 'original_account'
 	DESTINATION_ACCOUNT = 'destination_account'
 	TX = 'account_tx'
+	LEAFS = 'account_leafs'
+
+	LOG_FILE = 'records.log'
+	RECORD_HEADER = struct.Struct('>III')
 
-	def __init__(self, batch_id, path='./cache/'):
+	def __init__(self, batch_id, path='./cache/', lru_size=1000):
 		self.path_template = os.path.join(path, batch_id, '%s/')
-		self.fake_storage = {  # todo - use FS instead of memory
-			self.__path(self.ORIGINAL_ACCOUNT): {},
-			self.__path(self.DESTINATION_ACCOUNT): {},
-			self.__path(self.TX): {},
-		}
+		self.lru_size = lru_size
+		self.lru = collections.OrderedDict()
+		self.lock = threading.RLock()  # recovery probes accounts from worker threads
+		self.offsets = {}
+		for type in [self.ORIGINAL_ACCOUNT, self.DESTINATION_ACCOUNT, self.TX, self.LEAFS]:
+			self.__open(type)
 
 	def __path(self, type):
 		return self.path_template % type
 
+	def __log_path(self, type):
+		return os.path.join(self.__path(type), self.LOG_FILE)
+
+	def __open(self, type):
+		"""index all complete records of the log, truncating a torn record left by a crash"""
+		if not os.path.exists(self.__path(type)):
+			os.makedirs(self.__path(type))
+		offsets = self.offsets[type] = {}
+		valid_end = 0
+		with open(self.__log_path(type), 'a+b') as fp:
+			fp.seek(0)
+			while True:
+				offset = fp.tell()
+				header = fp.read(self.RECORD_HEADER.size)
+				if len(header) < self.RECORD_HEADER.size:
+					break
+				key_length, data_length, checksum = self.RECORD_HEADER.unpack(header)
+				body = fp.read(key_length + data_length)
+				if len(body) < key_length + data_length or zlib.crc32(body) & 0xffffffff != checksum:
+					break
+				offsets[pickle.loads(body[:key_length])] = offset
+				valid_end = fp.tell()
+			if header:
+				print "! cache %s: dropping incomplete record at byte %d" % (type, valid_end)
+				fp.truncate(valid_end)
+
+	@metrics.timed('cache_save', kind=DISK)
 	def save(self, type, index, data):
-		self.fake_storage[self.__path(type)][index] = pickle.dumps(data, protocol=-1)
+		key_bytes = pickle.dumps(index, protocol=-1)
+		data_bytes = pickle.dumps(data, protocol=-1)
+		body = key_bytes + data_bytes
+		with self.lock:
+			with open(self.__log_path(type), 'ab') as fp:
+				offset = fp.tell()
+				fp.write(self.RECORD_HEADER.pack(len(key_bytes), len(data_bytes), zlib.crc32(body) & 0xffffffff) + body)
+				fp.flush()
+				os.fsync(fp.fileno())
+			self.offsets[type][index] = offset
+			self.__remember(type, index, data_bytes)
 
 	def exists(self, type, index):
-		return index in self.fake_storage[self.__path(type)]
+		return index in self.offsets[type]
 
+	@metrics.timed('cache_load', kind=DISK)
 	def load(self, type, index):
-		return pickle.loads(self.fake_storage[self.__path(type)][index]) if self.exists(type, index) else None
+		with self.lock:
+			if not self.exists(type, index):
+				return None
+			try:
+				data_bytes = self.lru.pop((type, index))
+			except KeyError:
+				with open(self.__log_path(type), 'rb') as fp:
+					fp.seek(self.offsets[type][index])
+					key_length, data_length, checksum = self.RECORD_HEADER.unpack(fp.read(self.RECORD_HEADER.size))
+					data_bytes = fp.read(key_length + data_length)[key_length:]
+			self.__remember(type, index, data_bytes)
+		return pickle.loads(data_bytes)  # unpickling each time, callers mutate loaded objects
 
 	def count(self, type):
-		return len(self.fake_storage[self.__path(type)])
\ No newline at end of file
+		return len(self.offsets[type])
+
+	def __remember(self, type, index, data_bytes):
+		self.lru.pop((type, index), None)
+		self.lru[(type, index)] = data_bytes
+		while len(self.lru) > self.lru_size:
+			self.lru.popitem(last=False)
@@ -1,23 +1,20 @@
-from multisigcore.providers.insight import InsightBatchService
-from multisigcore.hierarchy import MasterKey
-from .branch import Branch, AccountPubkeys
-from .recovery import CachedRecovery
-from .batch import Batch
-import json
-from pycoin.encoding import EncodingError
+# Commands import what they use when they run, so eg. address or an offline cosign never load the insight client,
+# the oracle client or requests, and the CLI starts fast.
+import os.path
 try:
 	from termcolor import colored
 except ImportError:
 	def colored(text, color=None): print text
 
 
-__all__ = ['address', 'create', 'validate', 'cosign', 'broadcast', 'ScriptInputError']
+__all__ = ['address', 'create', 'validate', 'cosign', 'broadcast', 'convert', 'proofs', 'split', 'join', 'txcache', 'ScriptInputError']
 
 class ScriptInputError(Exception):
 	pass
 
 
 def __get_insight(url):
+	from multisigcore.providers.insight import InsightBatchService
 	insight = InsightBatchService(url)
 	try:
 		insight.get_blockchain_tip()
@@ -26,7 +23,18 @@ def __get_insight(url):
 	return insight
 
 
+def __get_snapshot(path, url):
+	"""accounts are discovered in the snapshot, insight is still asked for funding txs of the batch and oracle signing"""
+	from multisigcore.providers.insight import InsightBatchService
+	from .snapshot import UtxoSnapshot
+	try:
+		return UtxoSnapshot.from_export(path, provider=InsightBatchService(url))
+	except (IOError, OSError, ValueError) as err:
+		raise ScriptInputError('utxo snapshot %s: %s' % (path, err))
+
+
 def __parse_key_sources(key_sources_string, register=None):
+	from .branch import AccountPubkeys
 	try:
 		strings = key_sources_string.split(',')
 		return [AccountPubkeys.parse_string_to_account_key_source(string, register_oracle_accounts_file=register) for string in strings]
@@ -35,6 +43,7 @@ def __parse_key_sources(key_sources_string, register=None):
 
 
 def __get_template(string):
+	from .branch import Branch
 	return getattr(Branch, '%s_account' % string)
 
 
@@ -50,13 +59,12 @@ def __check_source_strings(args):
 
 
 def __add_known_accounts(cached_recovery, known_accounts_file):
-	with open(known_accounts_file) as fp:
-		known_accounts = json.load(fp)
-	for account_number, indexes in known_accounts.items():
-		if indexes is not None and 'external_leafs' in indexes and 'internal_leafs' in indexes:
-			cached_recovery.add_known_account(account_number, external_leafs=indexes['external_leafs'], internal_leafs=indexes['internal_leafs'])
-		else:
-			cached_recovery.add_known_account(account_number)
+	from .knownaccounts import iter_known_accounts
+	try:
+		for account_index, external_leafs, internal_leafs in iter_known_accounts(known_accounts_file):
+			cached_recovery.add_known_account(account_index, external_leafs=external_leafs, internal_leafs=internal_leafs)
+	except ValueError, err:
+		raise ScriptInputError('%s: %s' % (known_accounts_file, err))
 
 
 ############  create, cosign, broadcast methods below  ###########################################
@@ -64,6 +72,7 @@ def __add_known_accounts(cached_recovery, known_accounts_file):
 
 def address(args):
 	"""Will return address of specified path in a branch. Used to manyally cross-check that you are working on correct branch."""
+	from .branch import Branch
 	#insight = __get_insight(args.insight)
 	origin_key_sources = __parse_key_sources(args.origin)
 	origin_branch = Branch(origin_key_sources, account_template=__get_template(args.origin_template), provider=None)
@@ -78,27 +87,38 @@ def address(args):
 
 
 def create(args):
-	insight = __get_insight(args.insight)
+	from .branch import Branch
+	from .provider import AddressIndexProvider
+	from .recovery import CachedRecovery
+	if args.utxo_snapshot and not args.accounts:
+		raise ScriptInputError('--utxo-snapshot needs --accounts: addresses spent to zero look unused in a snapshot, so gap limit scans would stop before funded accounts behind them')
+	if args.utxo_snapshot:
+		insight = __get_snapshot(args.utxo_snapshot, args.insight)
+	else:
+		insight = AddressIndexProvider(__get_insight(args.insight))
 	__check_source_strings(args)
 
 	# setup
 	origin_key_sources = __parse_key_sources(args.origin)
 	origin_branch = Branch(origin_key_sources, account_template=__get_template(args.origin_template), provider=insight)
+	if args.pack > 1 and (origin_branch.needs_oracle or not origin_branch.has_private_keys):
+		raise ScriptInputError('--pack signs txs with private keys of the origin branch, give a seed or xprv in --origin\nOracle branches are swept one account per tx, leave out --pack')
 	destination_key_sources = __parse_key_sources(args.destination, register=args.register)
 	destination_branch = Branch(destination_key_sources, account_template=__get_template(args.destination_template), provider=insight)
-	cached_recovery = CachedRecovery(origin_branch, destination_branch, provider=insight)
+	cached_recovery = CachedRecovery(origin_branch, destination_branch, provider=insight, workers=args.workers, fee_rate=args.fee_rate)
 	if args.accounts:
 		__add_known_accounts(cached_recovery, args.accounts)
 
 	# recovery
 	cached_recovery.recover_origin_accounts()
 	cached_recovery.recover_destination_accounts()
-	cached_recovery.create_and_sign_txs()
+	cached_recovery.create_and_sign_txs(pack=args.pack)
 	print "Total to recover in this branch: %d" % cached_recovery.total_to_recover
 	if cached_recovery.total_to_recover:
-		cached_recovery.export_to_batch(args.save)
+		cached_recovery.export_to_batch(args.save, format=args.format)
 
 def validate(args):
+	from .batchfile import load_batch
 	try:
 		insight = __get_insight(args.insight)
 	except ScriptInputError:
@@ -107,8 +127,8 @@ def validate(args):
 	print ""
 
 	try:
-		batch = Batch.from_file(args.load)
-		batch.validate(provider=insight)
+		batch = load_batch(args.load)
+		batch.validate(provider=insight, workers=args.connections or 8, processes=args.workers)
 		error = None
 	except ValueError as err:
 		print "Validation failed", err
@@ -130,22 +150,90 @@ def validate(args):
 
 
 def cosign(args):
+	from multisigcore.hierarchy import MasterKey
+	from pycoin.encoding import EncodingError
+	from .batchfile import batch_writer, detect_format, load_batch
 	try:
 		backup_mpk = MasterKey.from_key(args.private)
 	except EncodingError:
 		backup_mpk = MasterKey.from_seed_hex(args.private)
-	batch = Batch.from_file(args.load)
+	batch = load_batch(args.load)
 	batch.validate()  # todo - validation
 	original_merkle_root = batch.merkle_root
-	batch.sign(master_private_key=backup_mpk)
-	if batch.merkle_root != original_merkle_root:
-		batch.to_file(args.save)
+	format = detect_format(args.load)
+	if format != 'json':  # signed txs are written out as they come, in the format of the loaded batch
+		writer = batch_writer(args.save, format, batch.original_master_xpubs, batch.destination_master_xpubs, checksum=batch.checksum)
+		try:
+			batch.sign(master_private_key=backup_mpk, workers=args.workers, writer=writer)
+		except:
+			writer.abort()
+			raise
+		if batch.merkle_root != original_merkle_root:
+			writer.close()
+		else:
+			writer.abort()
+			print "! All signatures failed: wrong private key used, or malformed batch"
 	else:
-		print "! All signatures failed: wrong private key used, or malformed batch"
+		batch.sign(master_private_key=backup_mpk, workers=args.workers)
+		if batch.merkle_root != original_merkle_root:
+			batch.to_file(args.save)
+		else:
+			print "! All signatures failed: wrong private key used, or malformed batch"
 
 
 def broadcast(args):
+	from .batchfile import load_batch
 	insight = __get_insight(args.insight)
-	batch = Batch.from_file(args.load)
+	batch = load_batch(args.load)
 	batch.validate()  # todo - validation
-	batch.broadcast(provider=insight)
+	batch.broadcast(provider=insight, journal_path='%s.journal' % args.load, connections=args.connections or 1, rate=args.rate)
+
+
+def convert(args):
+	"""Rewrites a batch in another format, eg. json to packed for indexed access to single txs."""
+	from .batchfile import load_batch, save_batch
+	batch = load_batch(args.load)
+	batch.validate()
+	save_batch(batch, args.save, format=args.format)
+
+
+def proofs(args):
+	"""Exports merkle inclusion proofs of all txs, so single txs can be checked against the header merkle root."""
+	from .batchfile import load_batch
+	batch = load_batch(args.load)
+	batch.validate()
+	batch.export_merkle_proofs(args.save)
+
+
+def split(args):
+	"""Splits a batch into --shards self-contained batches plus a manifest, to cosign on several machines."""
+	from . import shards
+	from .batchfile import load_batch
+	batch = load_batch(args.load)
+	batch.validate()
+	shards.split(batch, args.save, args.shards, format=args.format)
+
+
+def join(args):
+	"""--load MANIFEST[,SIGNED_SHARD,...] verifies signed shards against the manifest and joins them into one batch."""
+	from . import shards
+	paths = args.load.split(',')
+	try:
+		shards.join(paths[0], args.save, shard_paths=paths[1:], format=args.format)
+	except ValueError as err:
+		raise ScriptInputError(str(err))
+
+
+def txcache(args):
+	"""--load imports a tx pack or an old ./cache/tx_db directory into the local tx cache, --save exports the local tx cache."""
+	from .txdb import PackedTxDb
+	if args.load is None and args.save is None:
+		raise ScriptInputError('txcache: use --load to import, --save to export or both')
+	tx_db = PackedTxDb()
+	if args.load is not None:
+		if not os.path.exists(args.load):
+			raise ScriptInputError('txcache: %s does not exist' % args.load)
+		print "imported %d txs from %s" % (tx_db.import_txs(args.load), args.load)
+	if args.save is not None:
+		print "exported %d txs to %s" % (tx_db.export_txs(args.save), args.save)
+	tx_db.close()
@@ -0,0 +1,86 @@
+import collections
+import threading
+
+
+class DerivationCache(object):
+	"""
+	Bounded LRU of derived BIP32 nodes, keyed by root key and path prefix. Once any leaf under /account/chain/ was derived,
+	deriving a sibling leaf costs a single child step instead of walking the full path from the root.
+	Nodes derived by other means (eg. multisigcore account derivations) can be memoized under a label with node().
+	Hits and misses are counted per derivation step.
+	"""
+
+	HARDENED_SUFFIXES = "'pH"
+
+	def __init__(self, max_size=100000):
+		self.max_size = max_size
+		self.nodes = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def __root_id(key):
+		return key.chain_code(), key.secret_exponent() is not None
+
+	def subkey_for_path(self, key, path):
+		"""same as key.subkey_for_path(path), path like 0/1/5, hardened steps suffixed with H, p or '"""
+		steps = tuple(step for step in path.strip('/').split('/') if step)
+		root_id = self.__root_id(key)
+		node, start = key, 0
+		with self.lock:
+			for i in range(len(steps), 0, -1):
+				cached = self.__get((root_id, steps[:i]))
+				if cached is not None:
+					node, start = cached, i
+					break
+			self.hits += start
+			self.misses += len(steps) - start
+		for i in range(start, len(steps)):
+			step = steps[i]
+			is_hardened = step[-1] in self.HARDENED_SUFFIXES
+			node = node.subkey(i=int(step.rstrip(self.HARDENED_SUFFIXES)), is_hardened=is_hardened, as_private=node.secret_exponent() is not None)
+			with self.lock:
+				self.__put((root_id, steps[:i + 1]), node)
+		return node
+
+	def node(self, key, label, derive):
+		""":returns derive() memoized under (key, label)"""
+		cache_key = (self.__root_id(key), (label,))
+		with self.lock:
+			cached = self.__get(cache_key)
+			if cached is not None:
+				self.hits += 1
+				return cached
+			self.misses += 1
+		node = derive()
+		with self.lock:
+			self.__put(cache_key, node)
+		return node
+
+	def __get(self, cache_key):
+		node = self.nodes.pop(cache_key, None)
+		if node is not None:
+			self.nodes[cache_key] = node
+		return node
+
+	def __put(self, cache_key, node):
+		self.nodes.pop(cache_key, None)
+		self.nodes[cache_key] = node
+		while len(self.nodes) > self.max_size:
+			self.nodes.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.nodes.clear()
+			self.hits = self.misses = 0
+
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits * 1.0 / lookups if lookups else 0.0
+
+	def __str__(self):
+		return "%d hits, %d misses (%.1f%% hit rate), %d nodes cached" % (self.hits, self.misses, self.hit_rate() * 100, len(self.nodes))
+
+
+derivation_cache = DerivationCache()  # shared by batch signing and branch account derivation
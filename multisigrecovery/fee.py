@@ -0,0 +1,52 @@
+"""
+Closed-form sizes of m-of-n P2SH sweep txs, so the fee of a sweep is known from its input count before the tx is built.
+Signed input sizes follow from the redeem script, see multisig_input_size(), the defaults are of 2-of-3 compressed keys.
+"""
+from pycoin.convention.tx_fee import TX_FEE_PER_THOUSAND_BYTES
+
+MAX_STANDARD_TX_SIZE = 100000  # larger txs are not relayed by bitcoind
+TX_OVERHEAD_SIZE = 8  # version 4, lock time 4; varints of the input and output counts are added by tx_size()
+SIGNATURE_SIZE = 73  # DER signature with sighash byte, at most
+UNSIGNED_INPUT_SIZE = 41  # outpoint 36, empty script 1, sequence 4
+P2SH_OUTPUT_SIZE = 32  # value 8, script length 1, script 23
+
+
+def varint_size(n):
+	return 1 if n < 0xfd else 3 if n <= 0xffff else 5 if n <= 0xffffffff else 9
+
+
+def push_size(data_size):
+	""":returns size of the opcodes pushing data_size bytes"""
+	return 1 if data_size < 0x4c else 2 if data_size <= 0xff else 3
+
+
+def multisig_input_size(num_sigs, redeem_script_size):
+	""":returns upper bound of a signed P2SH input: outpoint 36, script length, script: OP_0, signatures, redeem script, sequence 4"""
+	script_size = 1 + num_sigs * (push_size(SIGNATURE_SIZE) + SIGNATURE_SIZE) + push_size(redeem_script_size) + redeem_script_size
+	return 36 + varint_size(script_size) + script_size + 4
+
+
+P2SH_MULTISIG_INPUT_SIZE = multisig_input_size(2, 105)  # 299, 2-of-3 redeem script of compressed keys: OP_2, 3 x (push + 33), OP_3, OP_CHECKMULTISIG
+
+
+def tx_size(input_count, output_count=1, signed=True, output_size=P2SH_OUTPUT_SIZE, input_size=P2SH_MULTISIG_INPUT_SIZE):
+	""":returns upper bound of serialized size in bytes, exact for unsigned txs, :param input_size: of a signed input"""
+	input_size = input_size if signed else UNSIGNED_INPUT_SIZE
+	return TX_OVERHEAD_SIZE + varint_size(input_count) + varint_size(output_count) + input_count * input_size + output_count * output_size
+
+
+def minimum_fee(input_count, output_count=1):
+	"""pycoin's recommended fee of the unsigned tx, which multisigcore requires when building a tx"""
+	return TX_FEE_PER_THOUSAND_BYTES * ((999 + tx_size(input_count, output_count, signed=False)) // 1000)
+
+
+def sweep_fee(input_count, fee_rate=None, output_count=1, input_size=P2SH_MULTISIG_INPUT_SIZE):
+	"""
+	:param fee_rate: satoshi per byte of the signed tx, None for pycoin's recommended fee only
+	:param input_size: of a signed input, see multisig_input_size()
+	:returns fee of a tx spending input_count P2SH outputs to output_count P2SH addresses
+	"""
+	fee = minimum_fee(input_count, output_count)
+	if fee_rate is not None:
+		fee = max(fee, int(fee_rate * tx_size(input_count, output_count, input_size=input_size)))
+	return fee
@@ -0,0 +1,134 @@
+"""
+Known accounts file: {account: null or {"external_leafs": leafs, "internal_leafs": leafs}, ...}, where account is an index
+or a range "first-last" and leafs is a list of leaf indexes and ranges, a single range, or a {leaf: address} map.
+Entries are read one by one and leaf ranges are kept as ranges, so large exports are never expanded in memory.
+	{"1": {"external_leafs": [0, 1, "5-4999"], "internal_leafs": "0-99"}, "2-10000": null}
+"""
+import json
+import re
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def parse_range(item):
+	""":returns (first, last) of an index or a "first-last" range, both inclusive"""
+	if isinstance(item, (int, long)):
+		first = last = item
+	elif isinstance(item, basestring) and re.match(r'^\s*\d+\s*(-\s*\d+\s*)?$', item):
+		bounds = item.split('-')
+		first, last = int(bounds[0]), int(bounds[-1])
+	else:
+		raise ValueError('%r is neither an index nor a range "first-last"' % (item,))
+	if first < 0 or first > last:
+		raise ValueError('bad range %r' % (item,))
+	return first, last
+
+
+class LeafRanges(object):
+	"""Leaf indexes given as indexes and ranges, iterated in order without expanding the ranges"""
+
+	def __init__(self, items=()):
+		if isinstance(items, (basestring, int, long)):
+			items = [items]
+		self.ranges = []
+		for first, last in sorted(parse_range(item) for item in items):  # merged, so no leaf is derived twice
+			if self.ranges and first <= self.ranges[-1][1] + 1:
+				self.ranges[-1] = (self.ranges[-1][0], max(last, self.ranges[-1][1]))
+			else:
+				self.ranges.append((first, last))
+
+	def __iter__(self):
+		for first, last in self.ranges:
+			for leaf_n in xrange(first, last + 1):
+				yield leaf_n
+
+	def __len__(self):
+		return sum(last - first + 1 for first, last in self.ranges)
+
+	def __contains__(self, leaf_n):
+		return any(first <= leaf_n <= last for first, last in self.ranges)
+
+	def __repr__(self):
+		return 'LeafRanges(%r)' % ['%d-%d' % leaf_range if leaf_range[0] != leaf_range[1] else leaf_range[0] for leaf_range in self.ranges]
+
+
+def leaf_set(leafs):
+	""":returns LeafRanges of a list of leafs and ranges, {leaf_n: address} of a map"""
+	if isinstance(leafs, LeafRanges):
+		return leafs
+	if isinstance(leafs, dict):
+		return {int(k): v for k, v in leafs.items()}
+	return LeafRanges(() if leafs is None else leafs)
+
+
+class JsonObjectReader(object):
+	"""Reads a top level json object item by item, holding one item and a chunk of the file in memory"""
+
+	def __init__(self, fp, chunk_size=1 << 16):
+		self.fp = fp
+		self.chunk_size = chunk_size
+		self.decoder = json.JSONDecoder()
+		self.buffer, self.position, self.eof = '', 0, False
+
+	def __read(self):
+		chunk = self.fp.read(self.chunk_size)
+		self.buffer, self.position, self.eof = self.buffer[self.position:] + chunk, 0, not chunk
+
+	def __skip_whitespace(self):
+		while True:
+			self.position = WHITESPACE.match(self.buffer, self.position).end()
+			if self.position < len(self.buffer) or self.eof:
+				return
+			self.__read()
+
+	def __char(self, expected):
+		self.__skip_whitespace()
+		char = self.buffer[self.position:self.position + 1]
+		if not char or char not in expected:
+			raise ValueError('expected one of %r at %r' % (expected, self.buffer[self.position:self.position + 20] or 'end of file'))
+		self.position += 1
+		return char
+
+	def __value(self):
+		self.__skip_whitespace()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.position)
+				if end < len(self.buffer) or self.eof:  # a number at the end of buffer may continue in the next chunk
+					self.position = end
+					return value
+			except ValueError:
+				if self.eof:
+					raise
+			self.__read()
+
+	def __iter__(self):
+		self.__char('{')
+		self.__skip_whitespace()
+		if self.buffer[self.position:self.position + 1] == '}':
+			self.position += 1
+			return
+		while True:
+			key = self.__value()
+			if not isinstance(key, basestring):
+				raise ValueError('object keys must be strings, got %r' % (key,))
+			self.__char(':')
+			yield key, self.__value()
+			if self.__char(',}') == '}':
+				return
+
+
+def iter_known_accounts(path):
+	"""
+	Streams known accounts of a file, account ranges yield each of their accounts sharing the same leafs.
+	:returns iterator of (account_index, external_leafs, internal_leafs), leafs None if to be scanned by the gap limit
+	"""
+	with open(path) as fp:
+		for account_key, indexes in JsonObjectReader(fp):
+			first, last = parse_range(account_key)
+			if indexes is not None and 'external_leafs' in indexes and 'internal_leafs' in indexes:
+				external_leafs, internal_leafs = leaf_set(indexes['external_leafs']), leaf_set(indexes['internal_leafs'])
+			else:
+				external_leafs = internal_leafs = None
+			for account_index in xrange(first, last + 1):
+				yield account_index, external_leafs, internal_leafs
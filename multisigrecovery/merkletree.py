@@ -0,0 +1,73 @@
+from pycoin.encoding import double_sha256
+from pycoin.serialize import b2h, b2h_rev, h2b, h2b_rev
+import bisect
+
+
+class MerkleTree(object):
+	"""
+	Merkle tree over sorted tx hashes, with the same root as pycoin.merkle.merkle(sorted(tx_hashes)).
+	All levels are kept, so replacing leafs (eg. txs that got signed) only rehashes nodes above the changed positions.
+	"""
+
+	def __init__(self, tx_hashes):
+		self.levels = [sorted(tx_hashes)]
+		self.__rehash(0, len(self.levels[0]))
+
+	def __rehash(self, start, end):
+		"""recompute parents of leaf positions [start, end)"""
+		level = 0
+		while len(self.levels[level]) > 1:
+			nodes = self.levels[level]
+			if level + 1 == len(self.levels):
+				self.levels.append([])
+			parents = self.levels[level + 1]
+			parent_count = (len(nodes) + 1) // 2
+			del parents[parent_count:]
+			start, end = start // 2, min((end + 1) // 2, parent_count)
+			for i in range(start, end):
+				left = nodes[2 * i]
+				right = nodes[2 * i + 1] if 2 * i + 1 < len(nodes) else left  # odd node is paired with itself
+				if i < len(parents):
+					parents[i] = double_sha256(left + right)
+				else:
+					parents.append(double_sha256(left + right))
+			level += 1
+		del self.levels[level + 1:]
+
+	def replace(self, changes):
+		""":param changes: [(old tx hash, new tx hash), ...], only the span of leaf positions that moved is rehashed"""
+		leafs = self.levels[0]
+		start, end = len(leafs), 0
+		for old_hash, new_hash in changes:
+			if old_hash == new_hash:
+				continue
+			old_position = bisect.bisect_left(leafs, old_hash)
+			del leafs[old_position]
+			new_position = bisect.bisect_left(leafs, new_hash)
+			leafs.insert(new_position, new_hash)
+			start, end = min(start, old_position, new_position), max(end, old_position + 1, new_position + 1)
+		if start < end:
+			self.__rehash(start, end)
+
+	def root(self):
+		return b2h_rev(self.levels[-1][0]) if self.levels[0] else None
+
+	def proof(self, tx_hash):
+		""":returns [(sibling hash hex, sibling is on the right), ...] from leaf to root"""
+		position = bisect.bisect_left(self.levels[0], tx_hash)
+		if position == len(self.levels[0]) or self.levels[0][position] != tx_hash:
+			raise KeyError('tx %s is not in the tree' % b2h_rev(tx_hash))
+		path = []
+		for nodes in self.levels[:-1]:
+			sibling = position ^ 1
+			path.append((b2h(nodes[sibling] if sibling < len(nodes) else nodes[position]), sibling > position))
+			position //= 2
+		return path
+
+
+def verify_merkle_proof(tx_id, path, merkle_root):
+	""":returns True if tx_id is included under merkle_root, path as returned by MerkleTree.proof"""
+	node = h2b_rev(tx_id)
+	for sibling, sibling_is_right in path:
+		node = double_sha256(node + h2b(sibling)) if sibling_is_right else double_sha256(h2b(sibling) + node)
+	return b2h_rev(node) == merkle_root
@@ -0,0 +1,197 @@
+"""
+Run instrumentation: timers and counters per stage, a progress line with throughput and ETA on stderr, and a report
+written as json or as a Prometheus textfile at the end of a run.
+Timers of a kind (network, cpu, disk) wrap single operations and don't nest, so their totals show where a run spends
+its time. Timers without a kind wrap whole stages (discovery, signing, ...) and include the operations inside.
+Stage seconds sum the timers of all threads, the seconds per kind are wall-clock: the union of the intervals in which
+any timer of the kind ran, so requests waited on by 8 threads at once count once and a kind never exceeds the run.
+"""
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+NETWORK, CPU, DISK = 'network', 'cpu', 'disk'
+TRACE_SIZE = 10000  # stage spans kept for the json trace
+
+
+class Progress(object):
+	"""Items done of a stage, redrawn on one stderr line at most every interval seconds. Total None if not known ahead."""
+
+	def __init__(self, stage, total=None, unit='items', interval=1.0, stream=sys.stderr):
+		self.stage, self.total, self.unit = stage, total, unit
+		self.interval = interval
+		self.stream = stream
+		self.done = 0
+		self.started = self.drawn = time.time()
+		self.lock = threading.Lock()
+
+	def update(self, count=1):
+		with self.lock:
+			self.done += count
+			if time.time() - self.drawn >= self.interval:
+				self.draw()
+
+	def rate(self):
+		elapsed = time.time() - self.started
+		return self.done / elapsed if elapsed > 0 else 0.0
+
+	def eta(self):
+		""":returns seconds left at the current rate or None"""
+		rate = self.rate()
+		if self.total is None or not rate:
+			return None
+		return max(0, self.total - self.done) / rate
+
+	def line(self):
+		done = '%d/%d' % (self.done, self.total) if self.total is not None else '%d' % self.done
+		eta = self.eta()
+		return '[%s] %s %s, %.1f/s%s' % (self.stage, done, self.unit, self.rate(), ', ETA %s' % _duration(eta) if eta is not None else '')
+
+	def draw(self, end=''):
+		self.drawn = time.time()
+		if self.stream.isatty():
+			self.stream.write('\r%s\033[K%s' % (self.line(), end))
+		elif end:  # logs get the final line only
+			self.stream.write(self.line() + end)
+		self.stream.flush()
+
+	def close(self):
+		with self.lock:
+			self.draw(end='\n')
+
+
+def _duration(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Metrics(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.timers = collections.OrderedDict()  # (name, kind): [calls, seconds, max seconds]
+		self.busy = {}  # kind: [timers running, wall-clock seconds of finished busy intervals, start of the running one]
+		self.counters = collections.Counter()
+		self.trace = collections.deque(maxlen=TRACE_SIZE)  # (stage, start offset, seconds) of stage timers
+		self.progresses = collections.OrderedDict()
+
+	@contextlib.contextmanager
+	def timer(self, name, kind=None):
+		started = time.time()
+		if kind is not None:
+			self.__busy(kind, 1, started)
+		try:
+			yield
+		finally:
+			ended = time.time()
+			if kind is not None:
+				self.__busy(kind, -1, ended)
+			self.add_time(name, ended - started, kind=kind, started=started)
+
+	def __busy(self, kind, running, now):
+		with self.lock:
+			busy = self.busy.setdefault(kind, [0, 0.0, None])
+			if running > 0 and not busy[0]:
+				busy[2] = now
+			busy[0] += running
+			if running < 0 and not busy[0]:
+				busy[1] += now - busy[2]
+
+	def timed(self, name, kind=None):
+		"""decorator version of timer()"""
+		def decorator(function):
+			@functools.wraps(function)
+			def wrapper(*args, **kwargs):
+				with self.timer(name, kind=kind):
+					return function(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	def add_time(self, name, seconds, kind=None, started=None):
+		"""adds to the stage seconds, the wall-clock seconds of a kind only count timer()"""
+		with self.lock:
+			timer = self.timers.setdefault((name, kind), [0, 0.0, 0.0])
+			timer[0] += 1
+			timer[1] += seconds
+			timer[2] = max(timer[2], seconds)
+			if kind is None:
+				self.trace.append((name, (started or time.time() - seconds) - self.started, seconds))
+
+	def count(self, name, count=1):
+		with self.lock:
+			self.counters[name] += count
+
+	def progress(self, stage, total=None, unit='items'):
+		""":returns a new Progress of stage, reported with the metrics"""
+		progress = self.progresses[stage] = Progress(stage, total=total, unit=unit)
+		return progress
+
+	def report(self):
+		now = time.time()
+		with self.lock:
+			kinds = dict((kind, seconds + (now - since if running else 0.0)) for kind, (running, seconds, since) in self.busy.items())
+		stages = collections.OrderedDict()
+		for (name, kind), (calls, seconds, max_seconds) in self.timers.items():
+			stages['%s/%s' % (kind, name) if kind else name] = {
+				'name': name, 'kind': kind, 'calls': calls, 'seconds': round(seconds, 6), 'max_seconds': round(max_seconds, 6),
+			}
+		return {
+			'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+			'seconds': round(now - self.started, 3),
+			'kinds': dict((kind, round(seconds, 3)) for kind, seconds in kinds.items()),
+			'stages': stages,
+			'counters': dict(self.counters),
+			'progress': dict((stage, {'done': progress.done, 'total': progress.total, 'rate': round(progress.rate(), 3)}) for stage, progress in self.progresses.items()),
+			'trace': [{'stage': name, 'start': round(start, 6), 'seconds': round(seconds, 6)} for name, start, seconds in self.trace],
+		}
+
+	def summary(self):
+		""":returns one line of wall-clock time per kind, eg. network 12.0s, cpu 3.1s, disk 0.4s of 16.2s"""
+		report = self.report()
+		kinds = ', '.join('%s %.1fs' % (kind, report['kinds'].get(kind, 0.0)) for kind in (NETWORK, CPU, DISK))
+		return '%s of %.1fs' % (kinds, report['seconds'])
+
+	def write_json(self, path):
+		_write_atomically(path, json.dumps(self.report(), indent=1))
+
+	def write_prometheus(self, path, prefix='multisigrecovery'):
+		"""textfile collector format, eg. for node_exporter --collector.textfile.directory"""
+		report = self.report()
+		lines = [
+			'# TYPE %s_run_seconds gauge' % prefix,
+			'%s_run_seconds %s' % (prefix, report['seconds']),
+			'# TYPE %s_stage_seconds_total counter' % prefix,
+		]
+		for stage in report['stages'].values():
+			lines.append('%s_stage_seconds_total{stage="%s",kind="%s"} %s' % (prefix, stage['name'], stage['kind'] or '', stage['seconds']))
+		lines.append('# TYPE %s_stage_calls_total counter' % prefix)
+		for stage in report['stages'].values():
+			lines.append('%s_stage_calls_total{stage="%s",kind="%s"} %d' % (prefix, stage['name'], stage['kind'] or '', stage['calls']))
+		lines.append('# TYPE %s_events_total counter' % prefix)
+		for name, count in sorted(report['counters'].items()):
+			lines.append('%s_events_total{name="%s"} %d' % (prefix, name, count))
+		lines.append('# TYPE %s_progress_done gauge' % prefix)
+		for stage, progress in report['progress'].items():
+			lines.append('%s_progress_done{stage="%s"} %d' % (prefix, stage, progress['done']))
+		lines.append('# TYPE %s_progress_total gauge' % prefix)
+		for stage, progress in report['progress'].items():
+			if progress['total'] is not None:
+				lines.append('%s_progress_total{stage="%s"} %d' % (prefix, stage, progress['total']))
+		_write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _write_atomically(path, text):
+	"""readers (eg. a textfile collector) never see a half written file"""
+	with open(path + '.tmp', 'w') as fp:
+		fp.write(text)
+	os.rename(path + '.tmp', path)
+
+
+metrics = Metrics()  # shared by all stages of a run
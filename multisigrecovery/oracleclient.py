@@ -0,0 +1,105 @@
+from .cache import ORACLE_KEYS_PATH
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import hashlib
+import json
+import os.path
+import requests
+import threading
+import types
+
+
+class PooledRequests(object):
+	"""
+	Stands in for the requests module in multisigcore.oracle: same get/post/put/delete functions, but over one session
+	with a pool of keep-alive connections, a default timeout and retries of failed connections and 5xx responses.
+	Retries don't apply to POST, so keychains are never created twice.
+	"""
+
+	def __init__(self, timeout=30, retries=3, connections=8):
+		self.timeout = timeout
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections, max_retries=Retry(
+			total=retries, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+		))
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return self.session.request(method, url, **kwargs)
+
+	def get(self, url, **kwargs):
+		return self.request('GET', url, **kwargs)
+
+	def post(self, url, data=None, **kwargs):
+		return self.request('POST', url, data=data, **kwargs)
+
+	def put(self, url, data=None, **kwargs):
+		return self.request('PUT', url, data=data, **kwargs)
+
+	def delete(self, url, **kwargs):
+		return self.request('DELETE', url, **kwargs)
+
+	def __getattr__(self, name):  # requests.exceptions, requests.codes, ...
+		return getattr(requests, name)
+
+
+def oracle_class(oracle_module, client):
+	"""
+	:returns subclass of oracle_module.Oracle whose code calls client where the module's code calls its module level
+	requests, so each oracle key source has its own client and the module itself is left as it is
+	"""
+	namespace = dict(vars(oracle_module), requests=client)
+
+	def rebind(function):
+		return types.FunctionType(function.__code__, namespace, function.__name__, function.__defaults__, function.__closure__)
+
+	for name, value in vars(oracle_module).items():  # helper functions of the module the Oracle methods call
+		if isinstance(value, types.FunctionType) and value.__module__ == oracle_module.__name__:
+			namespace[name] = rebind(value)
+	methods = {}
+	for cls in reversed(oracle_module.Oracle.__mro__):
+		if cls.__module__ != oracle_module.__name__:
+			continue
+		for name, value in vars(cls).items():
+			if isinstance(value, types.FunctionType):
+				methods[name] = rebind(value)
+			elif isinstance(value, (staticmethod, classmethod)):
+				methods[name] = type(value)(rebind(value.__func__))
+	return type(oracle_module.Oracle.__name__, (oracle_module.Oracle,), methods)
+
+
+def keychain_id(base_url, account_keys):
+	""":returns id of the oracle key for an account, by oracle url and the other keys of the account"""
+	return hashlib.sha256('\n'.join([base_url] + [key.hwif(as_private=False) for key in account_keys])).hexdigest()
+
+
+class OracleKeyCache(object):
+	"""Oracle keys fetched in earlier runs, json lines of {"keychain": keychain_id, "key": xpub}"""
+
+	def __init__(self, path=ORACLE_KEYS_PATH):
+		self.path = path
+		self.keys = {}
+		self.lock = threading.Lock()
+		if os.path.exists(path):
+			with open(path) as fp:
+				for line in fp:
+					try:
+						entry = json.loads(line)
+					except ValueError:  # torn last line of an interrupted run
+						continue
+					self.keys[entry['keychain']] = entry['key']
+		elif os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+
+	def get(self, keychain):
+		return self.keys.get(keychain)
+
+	def put(self, keychain, hwif):
+		with self.lock:
+			if self.keys.get(keychain) == hwif:
+				return
+			with open(self.path, 'a') as fp:
+				fp.write(json.dumps({'keychain': keychain, 'key': hwif}) + '\n')
+			self.keys[keychain] = hwif
@@ -0,0 +1,129 @@
+from .metrics import NETWORK, metrics
+import collections
+import json
+import threading
+import time
+try:
+	from urllib2 import urlopen
+	from urllib import urlencode
+except ImportError:
+	from urllib.request import urlopen
+	from urllib.parse import urlencode
+
+
+class AddressIndexProvider(object):
+	"""
+	Drop-in wrapper around InsightBatchService for accounts scanned during recovery.
+	Unspents are fetched through the multi-address endpoint in chunks of chunk_size addresses and memoized per address
+	for the whole run, so repeated balance()/spendables calls over a growing address map only query new addresses.
+	Everything else (get_tx, send_tx, get_blockchain_tip, ...) is passed through to the wrapped provider.
+	"""
+
+	CHUNK_SIZE = 300
+	HISTORY_PAGE_SIZE = 50  # insight caps /addrs/txs pages at 50 items
+
+	def __init__(self, provider, netcode='BTC', chunk_size=CHUNK_SIZE, timeout=30, retries=3, backoff=1.0):
+		self.provider = provider
+		self.netcode = netcode
+		self.chunk_size = chunk_size
+		self.timeout = timeout  # seconds per history request, retried with exponential backoff
+		self.retries = retries
+		self.backoff = backoff
+		self.spendables_by_address = {}
+		self.used_by_address = {}
+		self.lock = threading.Lock()
+
+	def __getattr__(self, name):
+		if name.startswith('__') or name in ('provider', 'spendables_by_address', 'used_by_address', 'lock', 'timeout', 'retries', 'backoff'):
+			raise AttributeError(name)
+		return getattr(self.provider, name)
+
+	def __getstate__(self):  # accounts get pickled into cache with their provider, the index itself stays in memory
+		return {'provider': self.provider, 'netcode': self.netcode, 'chunk_size': self.chunk_size, 'timeout': self.timeout, 'retries': self.retries, 'backoff': self.backoff}
+
+	def __setstate__(self, state):
+		self.__init__(**state)
+
+	def prefetch(self, addresses):
+		"""fetch unspents of all addresses not seen yet, chunk_size addresses per request"""
+		with self.lock:
+			missing = list(set(address for address in addresses if address not in self.spendables_by_address))
+		for i in range(0, len(missing), self.chunk_size):
+			chunk = missing[i:i + self.chunk_size]
+			fetched = dict((address, []) for address in chunk)
+			with metrics.timer('spendables_for_addresses', kind=NETWORK):
+				chunk_spendables = self.provider.spendables_for_addresses(chunk)
+			metrics.count('addresses_queried', len(chunk))
+			for spendable in chunk_spendables:
+				fetched.setdefault(spendable.bitcoin_address(self.netcode), []).append(spendable)
+			with self.lock:
+				self.spendables_by_address.update(fetched)
+
+	def spendables_for_address(self, address):
+		return self.spendables_for_addresses([address])
+
+	def spendables_for_addresses(self, addresses):
+		addresses = list(collections.OrderedDict.fromkeys(addresses))
+		self.prefetch(addresses)
+		spendables = []
+		for address in addresses:
+			spendables.extend(self.spendables_by_address[address])
+		return spendables
+
+	def balance_for_addresses(self, addresses):
+		return sum(spendable.coin_value for spendable in self.spendables_for_addresses(addresses))
+
+	def used_addresses(self, addresses):
+		"""
+		:returns set of addresses that appear in any transaction, memoized per address
+		Providers that can answer this themselves (eg. a local snapshot) are asked directly, otherwise insight is queried.
+		"""
+		addresses = list(collections.OrderedDict.fromkeys(addresses))
+		with self.lock:
+			missing = [address for address in addresses if address not in self.used_by_address]
+		for i in range(0, len(missing), self.chunk_size):
+			chunk = missing[i:i + self.chunk_size]
+			with metrics.timer('used_addresses', kind=NETWORK):
+				if hasattr(self.provider, 'used_addresses'):
+					used = self.provider.used_addresses(chunk)
+				else:
+					used = self.__insight_used_addresses(chunk)
+			metrics.count('addresses_checked', len(chunk))
+			with self.lock:
+				self.used_by_address.update((address, address in used) for address in chunk)
+		return set(address for address in addresses if self.used_by_address[address])
+
+	def __insight_used_addresses(self, addresses):
+		"""
+		Asks for the first /api/addrs/txs page of a group of addresses: addresses in its txs are used, and if the page
+		holds the group's whole history (totalItems) the others are not. Otherwise the others are halved and asked again,
+		so a busy address costs one page instead of its whole history.
+		"""
+		used, groups = set(), [list(addresses)]
+		while groups:
+			group = groups.pop()
+			data = urlencode({'addrs': ','.join(group), 'from': 0, 'to': self.HISTORY_PAGE_SIZE}).encode('utf8')
+			page = self.__post_json('%s/api/addrs/txs' % self.provider.base_url.rstrip('/'), data)
+			items, wanted, seen = page.get('items', []), set(group), set()
+			for tx in items:
+				seen.update(wanted.intersection(vin.get('addr') for vin in tx.get('vin', [])))
+				for vout in tx.get('vout', []):
+					seen.update(wanted.intersection(vout.get('scriptPubKey', {}).get('addresses') or []))
+			used.update(seen)
+			rest = [address for address in group if address not in seen]
+			if rest and page.get('totalItems', 0) > len(items):  # history goes on past this page
+				if len(group) == 1:
+					used.update(group)
+				else:
+					groups.extend(half for half in (rest[:len(rest) // 2], rest[len(rest) // 2:]) if half)
+		return used
+
+	def __post_json(self, url, data):
+		"""a stalled or failed request is retried with exponential backoff, the last failure is raised"""
+		for attempt in range(self.retries + 1):
+			try:
+				return json.loads(urlopen(url, data=data, timeout=self.timeout).read().decode('utf8'))
+			except IOError:  # urllib errors and socket timeouts
+				if attempt == self.retries:
+					raise
+				time.sleep(self.backoff * 2 ** attempt)
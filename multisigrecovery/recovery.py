@@ -1,8 +1,25 @@
-from batch import Batch, BatchableTx, Tx
+from batch import Batch, BatchableTx, Tx, full_leaf_path
+from batchfile import batch_writer, load_batch
 from cache import Cache
-from multisigcore.hierarchy import TX_FEE_PER_THOUSAND_BYTES, InsufficientBalanceException, MasterKey, AccountTx
+from derivation import derivation_cache
+from fee import MAX_STANDARD_TX_SIZE, P2SH_OUTPUT_SIZE, minimum_fee, multisig_input_size, sweep_fee, tx_size
+from knownaccounts import leaf_set
+from metrics import CPU, NETWORK, metrics
+from multisigcore.hierarchy import InsufficientBalanceException, MasterKey, AccountTx
 from multisigcore.oracle import OracleUnknownKeychainException
-from pycoin.services.tx_db import TxDb
+from multiprocessing.pool import ThreadPool
+from pycoin.encoding import hash160
+from pycoin.tx import TxOut
+from pycoin.tx.pay_to import ScriptMultisig, ScriptPayToScript, script_obj_from_address
+from signer import Signer
+import collections
+
+
+PackedWith = collections.namedtuple('PackedWith', 'account_index')  # cached instead of a tx for accounts swept by another account's packed tx
+
+
+class SweepError(ValueError):
+	"""multisigcore's tx of an account doesn't sweep all its unspents to the destination, the account is left uncached"""
 
 
 class CachedRecovery(object):
@@ -10,17 +27,21 @@ class CachedRecovery(object):
 	Create a batch of transactions from master branch keys. Will cache each step and pick up where left off.
 	"""
 
-	def __init__(self, origin_branch, destination_branch, provider, account_gap=5, leaf_gap=5, first_account=0):  # todo - increase gaps
+	def __init__(self, origin_branch, destination_branch, provider, account_gap=5, leaf_gap=5, first_account=0, workers=1, fee_rate=None):  # todo - increase gaps
 		self.origin_branch = origin_branch
+		self.provider = provider
 		self.destination_branch = destination_branch
 		self.cache = Cache(self.origin_branch.id)
 		self.known_accounts = {}
-		self.tx_db = TxDb(lookup_methods=[provider.get_tx], read_only_paths=[],	writable_cache_path='./cache/tx_db')
 		self.account_gap = account_gap
 		self.leaf_gap = leaf_gap
 		self.first_account = first_account
 		self.account_lookahead = True
-		self.total_to_recover = 0
+		self.total_to_recover = 0  # of all cached txs, set by create_and_sign_txs
+		self.workers = max(1, workers)  # accounts probed in parallel
+		self.fee_rate = fee_rate  # satoshi per byte, None for pycoin's recommended fee
+		self.signer = Signer()  # origin leaf keys and redeem scripts of all txs
+		self.multisig_shape = None  # (m, sorted keys) of the origin branch's redeem scripts, see __multisig_shape()
 
 	def add_known_account(self, account_index, external_leafs=None, internal_leafs=None):
 		"""
@@ -29,64 +50,71 @@ class CachedRecovery(object):
 		If leafs are not specified, addresses will be recovered using LEAF_GAP_LIMIT.
 			batch.add_known_account(0)
 			batch.add_known_account(1, external_leafs=[0,1,2,3,4], internal_leafs=[0,1,2])
+			batch.add_known_account(1, external_leafs=["0-4999", 6000], internal_leafs="0-99")
 			batch.add_known_account(1, external_leafs={0: "receiving addr 0", 1: "receiving addr 1", ...}, internal_leafs={0: "change addr 0", ...})
 		"""
-		external_leafs = external_leafs or {}
-		internal_leafs = internal_leafs or {}
-		self.known_accounts[int(account_index)] = {  # each branch stored as {leaf_i: None or receiving address, ...} or None
-			0: {int(v): None for v in external_leafs} if type(external_leafs) == list else {int(k): v for k, v in external_leafs.items()},
-			1: {int(v): None for v in internal_leafs} if type(internal_leafs) == list else {int(k): v for k, v in external_leafs.items()},
+		self.known_accounts[int(account_index)] = {  # each chain stored as LeafRanges, iterated lazily, or {leaf_i: address}
+			0: leaf_set(external_leafs),
+			1: leaf_set(internal_leafs),
 		}
 		self.account_lookahead = False
 
+	@metrics.timed('discovery')
 	def recover_origin_accounts(self):
 		"""will pick up where left off due to caching"""
-		if not self.account_lookahead:  # accounts already known
-			for account_index, leafs in self.known_accounts.items():
-				existed = self.recover_origin_account(account_index, internal_leafs=leafs[0], external_leafs=leafs[1])
-				if not existed:
-					self.known_accounts[account_index] = False
-		else:  # searching for accounts
-			accounts_ahead_to_check = self.account_gap
-			while accounts_ahead_to_check:
-				account_index = max(self.known_accounts.keys()) + 1 if self.known_accounts else 0
-				existed = self.recover_origin_account(account_index)
-				if existed:
-					accounts_ahead_to_check = self.account_gap
-					self.known_accounts[account_index] = True
-				else:
-					accounts_ahead_to_check -= 1
-					self.known_accounts[account_index] = False
+		pool = ThreadPool(self.workers)
+		progress = metrics.progress('discovery', total=None if self.account_lookahead else len(self.known_accounts), unit='accounts')
+		try:
+			if not self.account_lookahead:  # accounts already known
+				known_accounts = self.known_accounts.items()
+				results = [pool.apply_async(self.recover_origin_account, (account_index,), {'external_leafs': leafs[0], 'internal_leafs': leafs[1]}) for account_index, leafs in known_accounts]
+				for (account_index, leafs), result in zip(known_accounts, results):
+					if not result.get():
+						self.known_accounts[account_index] = False
+					progress.update()
+			else:  # searching for accounts, keeping a window of self.workers probes in flight
+				accounts_ahead_to_check = self.account_gap
+				next_index = max(self.known_accounts.keys()) + 1 if self.known_accounts else 0
+				probes = collections.deque()
+				while accounts_ahead_to_check:
+					while len(probes) < self.workers:
+						probes.append((next_index, pool.apply_async(self.recover_origin_account, (next_index,))))
+						next_index += 1
+					account_index, result = probes.popleft()  # results consumed in index order, probes past the gap are discarded
+					existed = result.get()
+					progress.update()
+					if existed:
+						accounts_ahead_to_check = self.account_gap
+						self.known_accounts[account_index] = True
+					else:
+						accounts_ahead_to_check -= 1
+						self.known_accounts[account_index] = False
+		finally:
+			pool.close()
+			pool.join()
+			progress.close()
+		metrics.count('accounts_found', sum(1 for found in self.known_accounts.values() if found))
 
 	def recover_origin_account(self, account_index, internal_leafs=None, external_leafs=None):
 		"""
 		:returns bool account_found
 		If Oracle is one of account sources, will return True on success from Oracle.
-		Else, will return True if there is any balance on the acct.
+		Else, will return True if any leaf of the acct has history, or if there is any balance on the acct.
 		"""
-		# todo - balance caching so we don't pull it repeatedly for each acct
-		# todo - not exising accounts should get cached too so we don't go through it again
 		account = self.cache.load(Cache.ORIGINAL_ACCOUNT, account_index)
-		if account is None:
+		if account is False:  # cached as unknown on a previous run
+			return False
+		if account is not None:
+			account._provider = self.provider  # share the run's address index instead of the unpickled copy
+		else:
 			try:
 				account = self.origin_branch.account(account_index)
-				if internal_leafs is None or external_leafs is None:
-					account.set_lookahead(self.leaf_gap)
-					previous_balance = 0
-					while True:
-						address_map = account.make_address_map(do_lookahead=True)
-						balance = account.balance()
-						if balance == previous_balance:
-							for address, path in address_map.items():
-								print 'original %d/%s %s' % (account_index, path, address)
-							break
-						else:
-							account._cache['issued']['0'] += self.leaf_gap  # todo - can be optimized
-							account._cache['issued']['0'] += self.leaf_gap
-							previous_balance = balance
+				if not internal_leafs and not external_leafs:
+					used_leafs = self.scan_leafs(account, account_index)
+					self.cache.save(Cache.LEAFS, account_index, used_leafs)
 				else:
 					account.set_lookahead(0)
-					for for_change, leaf_n_array in [(0, internal_leafs), (1, external_leafs)]:
+					for for_change, leaf_n_array in [(0, external_leafs), (1, internal_leafs)]:
 						for leaf_n in leaf_n_array:
 							address = account.address(leaf_n, change=int(for_change))  # this will get cached in the account object
 							print "original %d/%d/%d %s" % (account_index, for_change, leaf_n, address)
@@ -95,16 +123,49 @@ class CachedRecovery(object):
 				print "! account %d: unkown" % account_index
 				self.cache.save(Cache.ORIGINAL_ACCOUNT, account_index, False)
 				return False  # todo - needs more sophisticated checks, eg bad connection, CC timeouts, etc
-		return True if self.origin_branch.needs_oracle else bool(account.balance())
+		if self.origin_branch.needs_oracle:
+			return True
+		used_leafs = self.cache.load(Cache.LEAFS, account_index)
+		return bool(used_leafs and (used_leafs[0] or used_leafs[1])) or bool(account.balance())
+
+	@metrics.timed('leaf_scan')
+	def scan_leafs(self, account, account_index):
+		"""
+		Gap limit scan of both chains. Leafs are derived in windows reaching leaf_gap past the last used leaf and only the
+		newly derived addresses are checked for history, so the cost is linear in leafs used.
+		Leaves the account issued up to the last used leaf of each chain, without lookahead.
+		:returns {chain: {leaf_n: address}} of used leafs
+		"""
+		used_leafs = {}
+		for chain in (0, 1):
+			used_leafs[chain] = {}
+			last_used, next_leaf = -1, 0
+			while next_leaf <= last_used + self.leaf_gap:
+				window = dict((account.address(leaf_n, change=bool(chain)), leaf_n) for leaf_n in range(next_leaf, last_used + self.leaf_gap + 1))
+				next_leaf = last_used + self.leaf_gap + 1
+				metrics.count('addresses_derived', len(window))
+				for address in self.provider.used_addresses(window.keys()):
+					used_leafs[chain][window[address]] = address
+					last_used = max(last_used, window[address])
+			account._cache['issued'][str(chain)] = last_used + 1
+			for leaf_n, address in sorted(used_leafs[chain].items()):
+				print 'original %d/%d/%d %s' % (account_index, chain, leaf_n, address)
+		account.set_lookahead(0)
+		return used_leafs
 
+	@metrics.timed('destination_accounts')
 	def recover_destination_accounts(self):
 		"""will pick up where left off due to caching"""
-		for account_index in self.known_accounts:
-			if self.known_accounts[account_index] and not self.cache.exists(Cache.DESTINATION_ACCOUNT, account_index):
-				account = self.destination_branch.account(account_index)
-				address = account.address(0, change=False)  # this will get cached in the account object
-				print "destination %d/%d/%d %s" % (account_index, 0, 0, address)
-				self.cache.save(Cache.DESTINATION_ACCOUNT, account_index, account)
+		missing = [account_index for account_index in self.known_accounts if self.known_accounts[account_index] and not self.cache.exists(Cache.DESTINATION_ACCOUNT, account_index)]
+		self.destination_branch.prefetch_oracle_keys(missing, workers=self.workers)
+		progress = metrics.progress('destination_accounts', total=len(missing), unit='accounts')
+		for account_index in missing:
+			account = self.destination_branch.account(account_index)
+			address = account.address(0, change=False)  # this will get cached in the account object
+			print "destination %d/%d/%d %s" % (account_index, 0, 0, address)
+			self.cache.save(Cache.DESTINATION_ACCOUNT, account_index, account)
+			progress.update()
+		progress.close()
 
 	def create_and_sign_tx(self, account_index):
 		if not self.known_accounts[account_index]:
@@ -112,40 +173,219 @@ class CachedRecovery(object):
 		origin_account = self.cache.load(Cache.ORIGINAL_ACCOUNT, account_index)
 		destination_account = self.cache.load(Cache.DESTINATION_ACCOUNT, account_index)
 		destination_address = destination_account.address(0, False)  # from cache
-		balance = origin_account.balance()
-		balance_less_fee = balance - TX_FEE_PER_THOUSAND_BYTES
+		origin_account._provider = self.provider
+		spendables = origin_account.spendables()
+		balance = sum(spendable.coin_value for spendable in spendables)
+		input_size = self.__input_size(origin_account)
+		fee = sweep_fee(len(spendables), fee_rate=self.fee_rate, input_size=input_size)
 		account_tx = None
-		while balance_less_fee > 0:
-			try:  # todo - a function in multisigcore to withdraw all funds less fee
-				account_tx = origin_account.tx([(destination_address, balance_less_fee)])
-				self.total_to_recover += balance_less_fee
-				print "account", account_index, "balance:", balance, ", fee:", balance - balance_less_fee, ", recovering:", balance_less_fee, "in", account_tx.id()
-				break
-			except InsufficientBalanceException, err:
-				balance_less_fee -= TX_FEE_PER_THOUSAND_BYTES
+		if balance - fee > 0:
+			account_tx = self.__sweep_tx(account_index, origin_account, spendables, destination_address, balance - fee)
+			print "account", account_index, "balance:", balance, ", fee:", fee, "for", tx_size(len(spendables), input_size=input_size), "bytes, recovering:", balance - fee, "in", account_tx.id()
 		else:
 			print "account", account_index, "balance:", balance, ",nothing to send"
 
 		if account_tx is not None:
 			account_path = self.origin_branch.backup_account_path_template % account_index
-			origin_account.sign(account_tx)
+			if self.origin_branch.needs_oracle:
+				with metrics.timer('oracle_sign', kind=NETWORK):
+					origin_account.sign(account_tx)  # oracle signs remotely
+			else:
+				with metrics.timer('sign', kind=CPU):
+					keys, redeem_scripts = self.__origin_signing_keys(origin_account, account_tx)
+					self.signer.sign(account_tx, keys=keys, redeem_scripts=redeem_scripts)
+			metrics.count('txs_created')
 			return BatchableTx.from_tx(account_tx, output_paths=['0/0'], backup_account_path=account_path)
 
-	def create_and_sign_txs(self):
-		"""will pick up where left off due to caching"""
-		for account_index, leafs in self.known_accounts.items():
-			if not self.cache.exists(Cache.TX, account_index):
-				batchable_tx = self.create_and_sign_tx(account_index)
-				self.cache.save(Cache.TX, account_index, batchable_tx)
+	@staticmethod
+	def __sweep_tx(account_index, origin_account, spendables, destination_address, amount):
+		"""
+		:returns multisigcore tx of origin_account paying amount to destination_address from all spendables
+		multisigcore is asked for the balance less its minimum fee, which it can only pay from every unspent and without
+		change, then the output is lowered to amount. Raises SweepError if the tx comes out otherwise.
+		"""
+		requested = sum(spendable.coin_value for spendable in spendables) - minimum_fee(len(spendables))
+		try:
+			with metrics.timer('tx_build', kind=CPU):
+				account_tx = origin_account.tx([(destination_address, requested)])
+		except InsufficientBalanceException as err:
+			raise SweepError('account %d: multisigcore finds the balance insufficient for %d (%s)' % (account_index, requested, err))
+		spent = set((tx_in.previous_hash, tx_in.previous_index) for tx_in in account_tx.txs_in)
+		if len(account_tx.txs_in) != len(spendables) or spent != set((spendable.tx_hash, spendable.tx_out_index) for spendable in spendables):
+			raise SweepError('account %d: tx spends %d of %d unspents' % (account_index, len(spent), len(spendables)))
+		destination_script = script_obj_from_address(destination_address).script()
+		if [(tx_out.script, tx_out.coin_value) for tx_out in account_tx.txs_out] != [(destination_script, requested)]:
+			raise SweepError('account %d: tx has other outputs than %d to %s' % (account_index, requested, destination_address))
+		account_tx.txs_out[:] = [TxOut(amount, destination_script)]
+		return account_tx
+
+	@metrics.timed('create')
+	def create_and_sign_txs(self, pack=1):
+		"""will pick up where left off due to caching, total_to_recover includes txs cached by earlier runs"""
+		if pack > 1:
+			self.create_and_sign_packed_txs(pack)
+		else:
+			progress = metrics.progress('create', total=len(self.known_accounts), unit='accounts')
+			for account_index, leafs in self.known_accounts.items():
+				if not self.cache.exists(Cache.TX, account_index):
+					try:
+						batchable_tx = self.create_and_sign_tx(account_index)
+						self.cache.save(Cache.TX, account_index, batchable_tx)
+					except SweepError as err:
+						self.__skip(err)
+				progress.update()
+			progress.close()
+		self.total_to_recover = sum(batchable_tx.total_out() for batchable_tx in self.cached_txs())
 
-	def export_to_batch(self, path, return_batch=False):
-		batchable_txs = []
+	def cached_txs(self):
+		""":returns iterator of the cached txs of known accounts, in account order"""
 		for account_index in self.known_accounts:
 			batchable_tx = self.cache.load(Cache.TX, account_index)
-			if batchable_tx:
-				batchable_txs.append(batchable_tx)
-		batch = Batch(self.origin_branch.master_key_names, self.destination_branch.master_key_names, batchable_txs=batchable_txs)
+			if isinstance(batchable_tx, BatchableTx):  # not None, False or PackedWith
+				yield batchable_tx
+
+	def create_and_sign_packed_txs(self, pack):
+		"""
+		Sweeps up to pack accounts per tx, one output per destination account, keeping txs under the standard size limit.
+		Inputs are signed with the origin branch's private keys, multisigcore can only sign txs of a single account.
+		A packed tx is cached under its first account, the other accounts of the pack are cached as PackedWith(first account).
+		"""
+		group, group_inputs = [], 0
+		progress = metrics.progress('create', total=len(self.known_accounts), unit='accounts')
+		for account_index in self.known_accounts:
+			progress.update()
+			if not self.known_accounts[account_index] or self.__is_packed(account_index):
+				continue
+			try:
+				sweep = self.__account_sweep(account_index)
+			except SweepError as err:
+				self.__skip(err)
+				continue
+			if sweep is None:
+				self.cache.save(Cache.TX, account_index, None)
+				continue
+			inputs = len(sweep[2].txs_in)
+			if group and (len(group) == pack or tx_size(group_inputs + inputs, len(group) + 1, input_size=sweep[4]) > MAX_STANDARD_TX_SIZE):
+				self.__save_packed_tx(group)
+				group, group_inputs = [], 0
+			group.append(sweep)
+			group_inputs += inputs
+		if group:
+			self.__save_packed_tx(group)
+		progress.close()
+
+	@staticmethod
+	def __skip(err):
+		print "! %s, skipped and not cached, a later run tries again" % err
+		metrics.count('accounts_skipped')
+
+	def __account_sweep(self, account_index):
+		""":returns (account index, origin account, unsigned tx spending all its unspents, balance, input size) or None if not worth sweeping"""
+		origin_account = self.cache.load(Cache.ORIGINAL_ACCOUNT, account_index)
+		destination_address = self.cache.load(Cache.DESTINATION_ACCOUNT, account_index).address(0, False)
+		origin_account._provider = self.provider
+		spendables = origin_account.spendables()
+		balance = sum(spendable.coin_value for spendable in spendables)
+		input_size = self.__input_size(origin_account)
+		if balance <= sweep_fee(len(spendables), fee_rate=self.fee_rate, input_size=input_size):  # would not pay for its own inputs
+			print "account", account_index, "balance:", balance, ",nothing to send"
+			return None
+		account_tx = self.__sweep_tx(account_index, origin_account, spendables, destination_address, balance - minimum_fee(len(spendables)))  # for inputs, their paths and the output script
+		if account_tx is None:
+			return None
+		return account_index, origin_account, account_tx, balance, input_size  # account_tx spends all spendables, so balance is its input total
+
+	def __save_packed_tx(self, group):
+		input_count = sum(len(sweep[2].txs_in) for sweep in group)
+		input_size = max(sweep[4] for sweep in group)  # accounts of a branch share their redeem script shape
+		fee = sweep_fee(input_count, fee_rate=self.fee_rate, output_count=len(group), input_size=input_size)
+		total_bytes = input_count * input_size + len(group) * P2SH_OUTPUT_SIZE
+		txs_in, txs_out, unspents, input_paths, output_paths, keys, redeem_scripts = [], [], [], [], [], [], []
+		fee_left = fee
+		for i, (account_index, origin_account, account_tx, balance, account_input_size) in enumerate(group):
+			account_bytes = len(account_tx.txs_in) * input_size + P2SH_OUTPUT_SIZE
+			fee_share = fee_left if i == len(group) - 1 else fee * account_bytes // total_bytes  # each account pays for its own bytes
+			fee_left -= fee_share
+			account_path = self.origin_branch.backup_account_path_template % account_index
+			txs_in.extend(account_tx.txs_in)
+			unspents.extend(account_tx.unspents)
+			txs_out.append(TxOut(balance - fee_share, account_tx.txs_out[0].script))
+			output_paths.append(full_leaf_path(account_path, '0/0'))
+			input_paths.extend(full_leaf_path(account_path, leaf_path) for leaf_path in account_tx.input_chain_paths())
+			account_keys, account_redeem_scripts = self.__origin_signing_keys(origin_account, account_tx)
+			keys.extend(account_keys)
+			redeem_scripts.extend(account_redeem_scripts)
+		if not keys:
+			raise ValueError('packed txs are signed with private keys of the origin branch, none found for accounts %s' % [sweep[0] for sweep in group])
+		batchable_tx = BatchableTx(1, txs_in, txs_out, 0, unspents)
+		batchable_tx.input_paths, batchable_tx.output_paths = input_paths, output_paths
+		with metrics.timer('sign', kind=CPU):
+			self.signer.sign(batchable_tx, keys=keys, redeem_scripts=redeem_scripts)
+		metrics.count('txs_created')
+		print "accounts", ",".join(str(sweep[0]) for sweep in group), "balance:", sum(sweep[3] for sweep in group), ", fee:", fee, "for", \
+			tx_size(input_count, len(group), input_size=input_size), "bytes, recovering:", batchable_tx.total_out(), "in", batchable_tx.id()
+		for sweep in group[1:]:  # markers first, a run killed before the tx is saved packs these accounts again
+			self.cache.save(Cache.TX, sweep[0], PackedWith(group[0][0]))
+		self.cache.save(Cache.TX, group[0][0], batchable_tx)
+
+	def __is_packed(self, account_index):
+		""":returns True if the account's tx is cached, or the account was packed into a tx that is cached"""
+		if not self.cache.exists(Cache.TX, account_index):
+			return False
+		record = self.cache.load(Cache.TX, account_index)
+		return not isinstance(record, PackedWith) or self.cache.exists(Cache.TX, record.account_index)
+
+	def __multisig_shape(self, origin_account):
+		""":returns (m, sorted keys) of the origin branch's m-of-n redeem scripts, found once from an account's first address"""
+		if self.multisig_shape is None:
+			secs = [derivation_cache.subkey_for_path(key, '0/0').sec() for key in origin_account.keys]
+			p2sh_script = script_obj_from_address(origin_account.address(0, change=False)).script()
+			for num_sigs in range(1, len(secs) + 1):
+				for is_sorted in (True, False):
+					if ScriptPayToScript(hash160(ScriptMultisig(num_sigs, sorted(secs) if is_sorted else secs).script())).script() == p2sh_script:
+						self.multisig_shape = num_sigs, is_sorted
+						return self.multisig_shape
+			raise ValueError('no m-of-n redeem script of the origin account keys matches their address 0/0')
+		return self.multisig_shape
+
+	def __input_size(self, origin_account):
+		""":returns size of a signed input of the account, from its redeem script (m, key count and key lengths)"""
+		num_sigs, is_sorted = self.__multisig_shape(origin_account)
+		secs = [derivation_cache.subkey_for_path(key, '0/0').sec() for key in origin_account.keys]
+		return multisig_input_size(num_sigs, len(ScriptMultisig(num_sigs, secs).script()))
+
+	def __origin_signing_keys(self, origin_account, account_tx):
+		""":returns (private leaf keys, redeem scripts) of origin account inputs of account_tx"""
+		keys, redeem_scripts = [], []
+		for leaf_path, unspent in zip(account_tx.input_chain_paths(), account_tx.unspents):
+			leaf_keys, redeem_script = self.__leaf_redeem_script(origin_account, leaf_path, unspent.script)
+			keys.extend(key for key in leaf_keys if key.secret_exponent() is not None)
+			redeem_scripts.append(redeem_script)
+		return keys, redeem_scripts
+
+	def __leaf_redeem_script(self, origin_account, leaf_path, p2sh_script):
+		""":returns (leaf keys, redeem script) of the leaf, built in the branch's multisig shape and checked against the unspent"""
+		num_sigs, is_sorted = self.__multisig_shape(origin_account)
+		leaf_keys = [derivation_cache.subkey_for_path(key, leaf_path) for key in origin_account.keys]
+		secs = [key.sec() for key in leaf_keys]
+		redeem_script = ScriptMultisig(num_sigs, sorted(secs) if is_sorted else secs)
+		if ScriptPayToScript(hash160(redeem_script.script())).script() != p2sh_script:
+			raise ValueError('redeem script of leaf %s does not match its unspent' % leaf_path)
+		return leaf_keys, redeem_script
+
+	@metrics.timed('export')
+	def export_to_batch(self, path, return_batch=False, format='json'):
+		if format == 'json':
+			Batch(self.origin_branch.master_key_names, self.destination_branch.master_key_names, batchable_txs=list(self.cached_txs())).to_file(path)
+		else:  # stream or packed, txs go from cache to file one by one
+			with batch_writer(path, format, self.origin_branch.master_key_names, self.destination_branch.master_key_names) as writer:
+				for batchable_tx in self.cached_txs():
+					writer.write(batchable_tx)
+		batch = load_batch(path)
 		batch.validate()
-		batch.to_file(path)
+		try:  # funding txs go to the shared tx cache (cache.TX_PACK_PATH), so validation here or after txcache finds them
+			batch.prefetch_unspents(self.provider, workers=max(8, self.workers))
+		except Exception as err:
+			print "! funding txs not cached, validate will fetch them (%s)" % err
 		if return_batch:
-			return batch
\ No newline at end of file
+			return batch
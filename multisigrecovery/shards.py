@@ -0,0 +1,105 @@
+"""
+A batch can be split into self-contained shards to be signed on several machines in parallel. Each shard is a regular
+batch with the parent's xpubs, its own merkle root and total out. The manifest binds shards to the parent batch by
+merkle roots of blanked tx hashes (hashes with input scripts removed), which don't change when txs get signed.
+"""
+from .batch import Batch, merkle_root
+from .batchfile import batch_writer, load_batch
+import json
+import os.path
+
+
+def _blanked_root(batchable_txs):
+	return merkle_root([batchable_tx.blanked_hash() for batchable_tx in batchable_txs])
+
+
+def _shard_path(save_prefix, shard_i, shards):
+	return '%s.shard-%d-of-%d' % (save_prefix, shard_i + 1, shards)
+
+
+class _ListWriter(object):
+	"""collects a json shard in memory, json batches can't be written incrementally"""
+
+	def __init__(self, path, original_master_xpubs, destination_master_xpubs, checksum=-1):
+		self.path, self.batch_args, self.batchable_txs = path, (original_master_xpubs, destination_master_xpubs), []
+		self.checksum = checksum
+
+	def write(self, batchable_tx):
+		self.batchable_txs.append(batchable_tx)
+
+	def close(self):
+		Batch(*self.batch_args, batchable_txs=self.batchable_txs, checksum=self.checksum).to_file(self.path)
+
+
+def _writer(path, format, batch, checksum):
+	if format == 'json':
+		return _ListWriter(path, batch.original_master_xpubs, batch.destination_master_xpubs, checksum=checksum)
+	return batch_writer(path, format, batch.original_master_xpubs, batch.destination_master_xpubs, checksum=checksum)
+
+
+def split(batch, save_prefix, shards, format='json'):
+	""":returns path of the manifest, shards are written next to it as <save_prefix>.shard-<i>-of-<n>"""
+	count = len(batch.batchable_txs)
+	shards = max(1, min(shards, count))
+	writers = [_writer(_shard_path(save_prefix, shard_i, shards), format, batch, batch.checksum) for shard_i in range(shards)]
+	shard_entries = [{'file': os.path.basename(_shard_path(save_prefix, shard_i, shards)), 'count': 0, 'total_out': 0, 'blanked_hashes': []} for shard_i in range(shards)]
+	for tx_i, batchable_tx in enumerate(batch.batchable_txs):
+		shard_i = tx_i * shards // count  # contiguous ranges keep txs in batch order
+		writers[shard_i].write(batchable_tx)
+		shard_entries[shard_i]['count'] += 1
+		shard_entries[shard_i]['total_out'] += batchable_tx.total_out()
+		shard_entries[shard_i]['blanked_hashes'].append(batchable_tx.blanked_hash())
+	for writer, entry in zip(writers, shard_entries):
+		writer.close()
+		blanked_hashes = entry.pop('blanked_hashes')
+		entry['blanked_merkle_root'] = merkle_root(blanked_hashes)
+	manifest = {
+		'parent': {
+			'original_master_xpubs': batch.original_master_xpubs, 'destination_master_xpubs': batch.destination_master_xpubs,
+			'merkle_root': batch.merkle_root, 'total_out': batch.total_out, 'checksum': batch.checksum, 'count': count,
+			'blanked_merkle_root': _blanked_root(batch.batchable_txs),
+		},
+		'shards': shard_entries,
+	}
+	manifest_path = '%s.manifest.json' % save_prefix
+	with open(manifest_path, 'w') as fp:
+		json.dump(manifest, fp, indent=1)
+	print "save %s" % manifest_path
+	return manifest_path
+
+
+def join(manifest_path, save_path, shard_paths=None, format='json'):
+	"""
+	Verifies signed shards against the manifest and writes them as one batch in the original order. Streamed and packed
+	shards are read lazily.
+	:param shard_paths: signed shard files in any order, defaults to the unsigned shard files listed in the manifest
+	"""
+	with open(manifest_path) as fp:
+		manifest = json.load(fp)
+	parent = manifest['parent']
+	if not shard_paths:
+		shard_paths = [os.path.join(os.path.dirname(manifest_path), entry['file']) for entry in manifest['shards']]
+	shards_by_root = {}
+	for shard_path in shard_paths:
+		shard = load_batch(shard_path)
+		if shard.original_master_xpubs != parent['original_master_xpubs'] or shard.destination_master_xpubs != parent['destination_master_xpubs']:
+			raise ValueError('shard %s belongs to a different branch than %s' % (shard_path, manifest_path))
+		shards_by_root[_blanked_root(shard.batchable_txs)] = (shard_path, shard)
+	shards, blanked_hashes, total_out = [], [], 0
+	for entry in manifest['shards']:
+		if entry['blanked_merkle_root'] not in shards_by_root:
+			raise ValueError('shard %s missing or modified, no supplied file matches its transactions' % entry['file'])
+		shard_path, shard = shards_by_root[entry['blanked_merkle_root']]
+		shard.validate()
+		if len(shard.batchable_txs) != entry['count'] or shard.total_out != entry['total_out']:
+			raise ValueError('shard %s does not match manifest totals' % shard_path)
+		blanked_hashes.extend(batchable_tx.blanked_hash() for batchable_tx in shard.batchable_txs)
+		total_out += shard.total_out
+		shards.append(shard)
+	if total_out != parent['total_out'] or len(blanked_hashes) != parent['count'] or merkle_root(blanked_hashes) != parent['blanked_merkle_root']:
+		raise ValueError('joined shards do not match parent batch from %s' % manifest_path)
+	writer = _writer(save_path, format, shards[0], parent['checksum'])
+	for shard in shards:
+		for batchable_tx in shard.batchable_txs:
+			writer.write(batchable_tx)
+	writer.close()
@@ -0,0 +1,84 @@
+from .cache import SIGNATURE_CACHE_PATH
+from pycoin.encoding import double_sha256
+from pycoin.tx import Tx
+import os
+import os.path
+import struct
+import threading
+
+
+class SignatureCache(object):
+	"""
+	Persistent results of input signature checks. Records are appended to one file as (32 byte digest, ok flag), where the
+	digest covers the blanked tx hash, input index, input script and the spent output, so any changed signature or
+	unspent gets a new digest and is checked again. All records are loaded into a dict when opened.
+	"""
+
+	RECORD = struct.Struct('>32s?')
+
+	def __init__(self, path=SIGNATURE_CACHE_PATH):
+		self.path = path
+		self.results = {}
+		self.lock = threading.Lock()
+		if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'a+b') as fp:
+			fp.seek(0)
+			data = fp.read()
+			complete = len(data) - len(data) % self.RECORD.size
+			for offset in range(0, complete, self.RECORD.size):
+				digest, ok = self.RECORD.unpack_from(data, offset)
+				self.results[digest] = ok
+			if complete < len(data):  # torn record of an interrupted run
+				fp.truncate(complete)
+
+	@staticmethod
+	def digest(tx, input_index, blanked_hash=None):
+		tx_in, unspent = tx.txs_in[input_index], tx.unspents[input_index]
+		blanked_hash = blanked_hash or tx.blanked_hash()
+		return double_sha256(blanked_hash + struct.pack('>IQ', input_index, unspent.coin_value) + tx_in.script + b'\0' + unspent.script)
+
+	def get(self, digest):
+		""":returns True, False or None if not checked yet"""
+		return self.results.get(digest)
+
+	def add(self, results):
+		""":param results: [(digest, ok), ...]"""
+		with self.lock:
+			with open(self.path, 'ab') as fp:
+				fp.write(b''.join(self.RECORD.pack(digest, ok) for digest, ok in results))
+			self.results.update(results)
+
+
+def _check_inputs(args):
+	"""process pool worker, :returns [ok, ...] for the input indexes of one tx"""
+	tx_hex, input_indexes = args
+	tx = Tx.from_hex(tx_hex)
+	return [tx.is_signature_ok(input_index) for input_index in input_indexes]
+
+
+def bad_signature_counts(txs, cache, pool=None):
+	"""
+	:param txs: txs with unspents set
+	:param pool: multiprocessing.Pool to check inputs with, checked in this process if None
+	:returns {tx id: number of inputs with missing or bad signatures}, inputs found in cache are not checked again and
+		new results are added to it
+	"""
+	counts, jobs, job_digests = {}, [], []
+	for tx in txs:
+		blanked_hash = tx.blanked_hash()
+		digests = [SignatureCache.digest(tx, input_index, blanked_hash) for input_index in range(len(tx.txs_in))]
+		counts[tx.id()] = sum(1 for digest in digests if cache.get(digest) is False)
+		unchecked = [input_index for input_index, digest in enumerate(digests) if cache.get(digest) is None]
+		if unchecked:
+			jobs.append((tx.id(), (tx.as_hex(include_unspents=True), unchecked)))
+			job_digests.append([digests[input_index] for input_index in unchecked])
+	job_args = [job for tx_id, job in jobs]
+	checked = pool.map(_check_inputs, job_args) if pool is not None and len(jobs) > 1 else map(_check_inputs, job_args)
+	new_results = []
+	for (tx_id, job), digests, oks in zip(jobs, job_digests, checked):
+		counts[tx_id] += oks.count(False)
+		new_results.extend(zip(digests, oks))
+	if new_results:
+		cache.add(new_results)
+	return counts
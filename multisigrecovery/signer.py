@@ -0,0 +1,56 @@
+from pycoin.serialize import h2b
+from pycoin.tx.pay_to import build_hash160_lookup, build_p2sh_lookup
+from pycoin.tx.script.tools import opcode_list
+from .derivation import derivation_cache
+
+
+class Signer(object):
+	"""
+	Signs many txs, keeping hash160 -> secret exponent entries (one EC multiplication per key) and redeem scripts across
+	txs, so signing a tx whose keys and scripts were seen before costs just the ECDSA signatures.
+	With a master key, keys of each tx are derived from its input_paths, once per path.
+	"""
+
+	def __init__(self, master_private_key=None):
+		self.master_private_key = master_private_key
+		self.hash160_lookup = {}
+		self.p2sh_lookup = {}
+		self.paths = set()
+		self.secret_exponents = set()
+
+	def add_keys(self, keys):
+		secret_exponents = set(key.secret_exponent() for key in keys if key.secret_exponent() is not None) - self.secret_exponents
+		self.hash160_lookup.update(build_hash160_lookup(secret_exponents))
+		self.secret_exponents.update(secret_exponents)
+
+	def add_paths(self, paths):
+		new_paths = [path for path in paths if path not in self.paths]
+		self.add_keys([derivation_cache.subkey_for_path(self.master_private_key, path) for path in new_paths])
+		self.paths.update(new_paths)
+
+	def add_redeem_scripts(self, redeem_scripts):
+		self.p2sh_lookup.update(build_p2sh_lookup([script.script() for script in redeem_scripts]))
+
+	def __add_scripts_from_tx(self, tx):
+		"""redeem scripts of partially signed inputs, parsed only for P2SH outputs not seen before"""
+		for tx_in, unspent in zip(tx.txs_in, tx.unspents or [None] * len(tx.txs_in)):
+			if unspent is not None and unspent.script[2:22] in self.p2sh_lookup:
+				continue
+			if tx_in.script:
+				self.p2sh_lookup.update(build_p2sh_lookup([h2b(opcode_list(tx_in.script)[-1])]))
+
+	def sign(self, tx, keys=None, redeem_scripts=None):
+		"""
+		:param keys: keys to sign with, defaults to keys derived from the master key by tx.input_paths
+		:param redeem_scripts: required when adding first signature only, otherwise parsed from tx
+		"""
+		if keys:
+			self.add_keys(keys)
+		elif self.master_private_key is not None:
+			self.add_paths(tx.input_paths)
+		if redeem_scripts:
+			self.add_redeem_scripts(redeem_scripts)
+		else:
+			self.__add_scripts_from_tx(tx)
+		tx.sign(self.hash160_lookup, p2sh_lookup=self.p2sh_lookup)
+		return tx
@@ -0,0 +1,228 @@
+"""
+Local address index of a UTXO set snapshot exported from a node as csv rows address,txid,vout,value (value in
+satoshi, a header row naming these columns may list them in any order, eg. with amount in BTC for value). Rows
+without a base58 address (bech32, non-standard outputs) are skipped and counted. The export is sorted into a store
+once and kept under ./cache/utxo_snapshots/, later runs memory-map the store:
+	header (magic, count) | fanout: 65536 cumulative counts by the first 2 bytes of hash160 | sorted entries
+	entry: hash160 + address version byte, txid (internal byte order), vout, value
+An address lookup narrows to its fanout bucket and binary searches it, so gap limit scans check derived addresses
+without a request per address. Exports larger than memory are sorted in runs that are merged into the store.
+"""
+from .cache import UTXO_SNAPSHOTS_PATH
+from .metrics import DISK, metrics
+from pycoin.convention import btc_to_satoshi
+from pycoin.encoding import a2b_hashed_base58
+from pycoin.serialize import h2b_rev
+from pycoin.tx import Spendable
+from pycoin.tx.pay_to import script_obj_from_address
+import bisect
+import collections
+import csv
+import heapq
+import mmap
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+
+MAGIC = b'MSRUTXO1'
+HEADER = struct.Struct('>8sQ')
+FANOUT = struct.Struct('>65536I')
+KEY_SIZE = 21
+ENTRY = struct.Struct('>21s32sIQ')
+RUN_SIZE = 1000000  # entries sorted in memory at once, ~65MB of entries
+
+
+def address_key(address):
+	""":returns 21 byte index key of an address, hash160 first so keys spread evenly over the fanout"""
+	data = a2b_hashed_base58(address)
+	return data[1:] + data[:1]
+
+
+def iter_csv_export(path):
+	"""streams (address, txid, vout, value) from csv rows, columns named by a header row or in this order"""
+	with open(path) as fp:
+		columns, to_satoshi = None, int
+		for row in csv.reader(fp):
+			if not row:
+				continue
+			if columns is None and not row[-1].strip().isdigit():
+				names = [name.strip().lower() for name in row]
+				try:
+					columns = [names.index(name) for name in ('address', 'txid', 'vout')] + [names.index('value' if 'value' in names else 'amount')]
+				except ValueError:
+					raise ValueError('%s: header needs address, txid, vout and value columns, got %s' % (path, ','.join(row)))
+				if 'value' not in names:
+					to_satoshi = btc_to_satoshi  # amount is in BTC, eg. 0.5
+				continue
+			address, txid, vout, value = [row[i].strip() for i in columns or range(4)]
+			yield address, txid, int(vout), to_satoshi(value)
+
+
+def _entries(rows):
+	"""packs rows into entries, None for rows that can't be indexed"""
+	for address, txid, vout, value in rows:
+		try:
+			yield ENTRY.pack(address_key(address), h2b_rev(txid), vout, value)
+		except Exception:
+			metrics.count('snapshot_rows_skipped')  # eg. bech32 or non-standard outputs exported without an address
+			yield None
+
+
+def _read_run(path):
+	with open(path, 'rb') as fp:
+		while True:
+			entry = fp.read(ENTRY.size)
+			if len(entry) < ENTRY.size:
+				return
+			yield entry
+
+
+def write_store(fp, rows, run_size=RUN_SIZE):
+	"""writes (address, txid, vout, value) rows given in any order as store to fp, :returns (entries, skipped rows)"""
+	directory = tempfile.mkdtemp(prefix='utxo-runs-', dir=os.path.dirname(getattr(fp, 'name', '')) or None)
+	try:
+		run_paths, run, count, skipped = [], [], 0, 0
+		progress = metrics.progress('snapshot_index', unit='utxos')
+		for entry in _entries(rows):
+			if entry is None:
+				skipped += 1
+				continue
+			run.append(entry)
+			count += 1
+			if len(run) == run_size:
+				run_paths.append(_write_run(directory, len(run_paths), run))
+				progress.update(len(run))
+				run = []
+		progress.update(len(run))
+		progress.close()
+		if run_paths:
+			if run:
+				run_paths.append(_write_run(directory, len(run_paths), run))
+			entries = heapq.merge(*[_read_run(path) for path in run_paths])
+		else:
+			entries = sorted(run)
+
+		fanout = [0] * 65536
+		fp.write(HEADER.pack(MAGIC, count))
+		fanout_offset = fp.tell()
+		fp.write(FANOUT.pack(*fanout))
+		for entry in entries:
+			fanout[struct.unpack_from('>H', entry)[0]] += 1
+			fp.write(entry)
+		for i in range(1, len(fanout)):
+			fanout[i] += fanout[i - 1]
+		fp.seek(fanout_offset)
+		fp.write(FANOUT.pack(*fanout))
+		fp.seek(0, os.SEEK_END)
+	finally:
+		shutil.rmtree(directory)
+	return count, skipped
+
+
+def _write_run(directory, number, run):
+	run.sort()
+	path = os.path.join(directory, '%d.run' % number)
+	with open(path, 'wb') as fp:
+		fp.write(b''.join(run))
+	return path
+
+
+class UtxoSnapshot(object):
+	"""
+	Provider answering unspents and address use of a UTXO snapshot store instead of insight, for create. Addresses whose
+	outputs were all spent before the snapshot look unused, as only unspent outputs are exported, so create needs the
+	known accounts with it. Everything else (get_tx of funding txs for the batch and oracle signing, ...) is passed through
+	to the wrapped provider, which stays online.
+	"""
+
+	@classmethod
+	def from_export(cls, path, provider=None, cache_path=UTXO_SNAPSHOTS_PATH):
+		"""Sorts a csv export into a store file named by the export's name, size and mtime, or maps the store of an earlier run."""
+		stat = os.stat(path)
+		store_path = os.path.join(cache_path, '%s-%d-%d.utxos' % (os.path.basename(path), stat.st_size, int(stat.st_mtime)))
+		if not os.path.exists(store_path):
+			if not os.path.exists(cache_path):
+				os.makedirs(cache_path)
+			try:
+				with metrics.timer('snapshot_index', kind=DISK):
+					with open(store_path + '.part', 'wb') as fp:
+						count, skipped = write_store(fp, iter_csv_export(path))
+				if skipped:
+					sys.stderr.write('! %s: %d of %d rows skipped, their address is not base58 (eg. bech32) or their txid is malformed\n' % (path, skipped, count + skipped))
+				if not count:
+					raise ValueError('no row could be indexed')
+			except:
+				if os.path.exists(store_path + '.part'):
+					os.remove(store_path + '.part')
+				raise
+			os.rename(store_path + '.part', store_path)
+		return cls(store_path, provider=provider)
+
+	def __init__(self, store_path, provider=None):
+		self.store_path = store_path
+		self.provider = provider
+		with open(store_path, 'rb') as fp:
+			self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count = HEADER.unpack_from(self.data, 0)
+		if magic != MAGIC:
+			raise ValueError('%s is not a utxo snapshot store' % store_path)
+		self.fanout = FANOUT.unpack_from(self.data, HEADER.size)
+		self.entries_offset = HEADER.size + FANOUT.size
+
+	def __getattr__(self, name):
+		if name.startswith('__') or name in ('provider', 'data', 'fanout'):
+			raise AttributeError(name)
+		if self.provider is None:
+			raise AttributeError('%s needs a provider, the snapshot only knows unspents' % name)
+		return getattr(self.provider, name)
+
+	def __getstate__(self):  # cached accounts are pickled with their provider, recovery reconnects them to the live one
+		return {}
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, position):
+		""":returns key of entry at position, for bisect"""
+		offset = self.entries_offset + position * ENTRY.size
+		return self.data[offset:offset + KEY_SIZE]
+
+	def unspents(self, address):
+		""":returns [(txid bytes, vout, value), ...] of address"""
+		key = address_key(address)
+		bucket = struct.unpack_from('>H', key)[0]
+		position = bisect.bisect_left(self, key, self.fanout[bucket - 1] if bucket else 0, self.fanout[bucket])
+		unspents = []
+		while position < self.count and self[position] == key:
+			unspents.append(ENTRY.unpack_from(self.data, self.entries_offset + position * ENTRY.size)[1:])
+			position += 1
+		return unspents
+
+	def spendables_for_address(self, address):
+		return self.spendables_for_addresses([address])
+
+	def spendables_for_addresses(self, addresses):
+		addresses = list(collections.OrderedDict.fromkeys(addresses))
+		spendables = []
+		with metrics.timer('snapshot_lookup', kind=DISK):
+			for address in addresses:
+				unspents = self.unspents(address)
+				if unspents:
+					script = script_obj_from_address(address).script()
+					spendables.extend(Spendable(value, script, tx_hash, vout) for tx_hash, vout, value in unspents)
+		metrics.count('addresses_looked_up', len(addresses))
+		return spendables
+
+	def balance_for_addresses(self, addresses):
+		return sum(spendable.coin_value for spendable in self.spendables_for_addresses(addresses))
+
+	def used_addresses(self, addresses):
+		""":returns set of addresses holding unspents in the snapshot"""
+		addresses = list(addresses)
+		with metrics.timer('snapshot_lookup', kind=DISK):
+			used = set(address for address in addresses if self.unspents(address))
+		metrics.count('addresses_looked_up', len(addresses))
+		return used
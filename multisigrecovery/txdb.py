@@ -0,0 +1,159 @@
+from .cache import TX_PACK_PATH
+from pycoin.serialize import b2h_rev
+from pycoin.tx import Tx
+import glob
+import io
+import os
+import os.path
+import struct
+import threading
+import zlib
+
+
+class PackedTxDb(object):
+	"""
+	Drop-in for pycoin's TxDb that keeps all txs in one append-only pack file instead of a file per tx:
+		<path>       records: (tx hash, tx length, crc32) + tx bytes
+		<path>.idx   (tx hash, record offset, tx length) per record, loaded into memory when opened
+	A get is a dict lookup and a single read from the pack. Records the index lost in a crash are recovered from the pack,
+	a torn record at the end of the pack is truncated.
+	"""
+
+	RECORD_HEADER = struct.Struct('>32sII')
+	INDEX_ENTRY = struct.Struct('>32sQI')
+
+	def __init__(self, lookup_methods=[], path=TX_PACK_PATH):
+		self.lookup_methods = lookup_methods
+		self.path = path
+		self.index_path = path + '.idx'
+		self.offsets = {}  # tx hash: (record offset, tx length)
+		self.lock = threading.Lock()
+		if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		self.__open()
+		self.fp = open(self.path, 'r+b')
+
+	def __open(self):
+		with open(self.path, 'a+b') as pack, open(self.index_path, 'a+b') as index:
+			pack.seek(0, os.SEEK_END)
+			pack_size = pack.tell()
+			index.seek(0)
+			data = index.read()
+			end, index_end = 0, 0
+			for position in range(0, len(data) - self.INDEX_ENTRY.size + 1, self.INDEX_ENTRY.size):
+				tx_hash, offset, length = self.INDEX_ENTRY.unpack_from(data, position)
+				if offset + self.RECORD_HEADER.size + length > pack_size:
+					break
+				self.offsets[tx_hash] = (offset, length)
+				end, index_end = max(end, offset + self.RECORD_HEADER.size + length), position + self.INDEX_ENTRY.size
+			index.truncate(index_end)
+			recovered = []
+			pack.seek(end)
+			while True:
+				offset = pack.tell()
+				header = pack.read(self.RECORD_HEADER.size)
+				if len(header) < self.RECORD_HEADER.size:
+					break
+				tx_hash, length, checksum = self.RECORD_HEADER.unpack(header)
+				tx_bytes = pack.read(length)
+				if len(tx_bytes) < length or zlib.crc32(tx_bytes) & 0xffffffff != checksum:
+					break
+				self.offsets[tx_hash] = (offset, length)
+				recovered.append(self.INDEX_ENTRY.pack(tx_hash, offset, length))
+				end = pack.tell()
+			if end < pack_size:
+				print "! tx pack %s: dropping incomplete record at byte %d" % (self.path, end)
+				pack.truncate(end)
+			index.write(b''.join(recovered))
+
+	def get(self, key):
+		with self.lock:
+			location = self.offsets.get(key)
+			if location is not None:
+				offset, length = location
+				self.fp.seek(offset + self.RECORD_HEADER.size)
+				return Tx.parse(io.BytesIO(self.fp.read(length)))
+		for method in self.lookup_methods:
+			try:
+				tx = method(key)
+				if tx and tx.hash() == key:
+					self.put(tx)
+					return tx
+			except Exception:
+				pass
+		return None
+
+	def put(self, tx):
+		self.put_bin(tx.hash(), tx.as_bin())
+
+	def put_bin(self, tx_hash, tx_bytes):
+		with self.lock:
+			if tx_hash in self.offsets:
+				return
+			self.fp.seek(0, os.SEEK_END)
+			offset = self.fp.tell()
+			self.fp.write(self.RECORD_HEADER.pack(tx_hash, len(tx_bytes), zlib.crc32(tx_bytes) & 0xffffffff) + tx_bytes)
+			self.fp.flush()
+			with open(self.index_path, 'ab') as index:
+				index.write(self.INDEX_ENTRY.pack(tx_hash, offset, len(tx_bytes)))
+			self.offsets[tx_hash] = (offset, len(tx_bytes))
+
+	def get_bin(self, tx_hash):
+		with self.lock:
+			offset, length = self.offsets[tx_hash]
+			self.fp.seek(offset + self.RECORD_HEADER.size)
+			return self.fp.read(length)
+
+	def import_txs(self, source):
+		"""
+		Bulk import from a directory of pycoin TxDb files (<tx id>_tx.bin) or from another pack file.
+		:returns number of txs added
+		"""
+		count = len(self)
+		if os.path.isdir(source):
+			for file_path in glob.glob(os.path.join(source, '*_tx.bin')):
+				with open(file_path, 'rb') as fp:
+					tx_bytes = fp.read()
+				tx = Tx.parse(io.BytesIO(tx_bytes))
+				if tx.id() == os.path.basename(file_path)[:-len('_tx.bin')]:
+					self.put(tx)
+		else:
+			other = PackedTxDb(path=source)
+			for tx_hash in other:
+				self.put_bin(tx_hash, other.get_bin(tx_hash))
+			other.close()
+		return len(self) - count
+
+	def export_txs(self, path):
+		"""writes all txs into a new, compacted pack file at path, eg. to pre-warm the store on another host"""
+		for file_path in [path, path + '.idx']:
+			if os.path.exists(file_path):
+				os.remove(file_path)
+		other = PackedTxDb(path=path)
+		for tx_hash in sorted(self.offsets, key=lambda tx_hash: self.offsets[tx_hash][0]):
+			other.put_bin(tx_hash, self.get_bin(tx_hash))
+		other.close()
+		return len(self)
+
+	def close(self):
+		self.fp.close()
+
+	def __contains__(self, key):
+		return key in self.offsets
+
+	def __iter__(self):
+		return iter(list(self.offsets))
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __getitem__(self, key):
+		tx = self.get(key)
+		if tx is None:
+			raise KeyError(b2h_rev(key))
+		return tx
+
+	def __setitem__(self, key, val):
+		if val.hash() != key:
+			raise ValueError("bad key %s for %s" % (b2h_rev(key), val))
+		self.put(val)
@@ -0,0 +1,222 @@
+#!/usr/bin/python2.7
+
+# Offline micro-benchmarks of the hot paths: account and address derivation, batch signing, merkle root, batch
+# serialization and utxo snapshot indexing and lookups. Txs are synthetic, 2 of 3 P2SH of the test seeds in
+# tests/__init__.py, no insight node or coins needed.
+# A pool of txs carrying the first signature is created once and kept in ./cache/bench-signed-pool.txs, larger batches repeat
+# its txs with distinct made up inputs, so their signatures don't verify but serialize and hash like real ones.
+# Results are written as json. Given the results of an earlier run as baseline, benchmarks slower by more than the
+# tolerance are reported as regressions and the script exits with status 1.
+
+# usage:
+# ./test bench --save bench.json
+# ./test bench --baseline bench.json --sizes 1000,10000
+
+from . import get_test_master_keys, get_test_master_xpub_keys, get_test_master_xpub_strings
+from multisigrecovery.batch import Batch, BatchableTx
+from multisigrecovery.branch import Branch
+from multisigrecovery.derivation import derivation_cache
+from multisigrecovery.signer import Signer
+from multisigrecovery.snapshot import UtxoSnapshot
+from pycoin.encoding import hash160, hash160_sec_to_bitcoin_address
+from pycoin.serialize import b2h_rev
+from pycoin.tx import TxIn, TxOut, Spendable
+from pycoin.tx.pay_to import ScriptMultisig, ScriptPayToScript
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+SIGNED_POOL_FILE = './cache/bench-signed-pool.txs'
+
+
+@contextlib.contextmanager
+def quiet():
+	"""keeps per tx prints of the benchmarked code out of timings and output"""
+	stdout = sys.stdout
+	with open(os.devnull, 'w') as devnull:
+		sys.stdout = devnull
+		try:
+			yield
+		finally:
+			sys.stdout = stdout
+
+
+class Benchmarks(object):
+
+	def __init__(self, repeat=3):
+		self.repeat = repeat
+		self.results = collections.OrderedDict()
+
+	def time(self, name, items, run, setup=lambda: None):
+		"""records the fastest of repeat runs of run(setup()), setup is not timed"""
+		timings = []
+		for i in range(self.repeat):
+			args = setup()
+			with quiet():
+				started = timeit.default_timer()
+				run(args)
+				timings.append(timeit.default_timer() - started)
+		seconds = min(timings)
+		self.results[name] = {'items': items, 'seconds': round(seconds, 6), 'us_per_item': round(seconds * 10**6 / items, 3)}
+		print "[bench] %-30s %10.4fs %12.2fus/item" % (name, seconds, seconds * 10**6 / items)
+
+
+def build_signed_pool(size, master_keys):
+	""":returns size txs, each spending a made up output of leaf 0/0 of its own account, signed by the first key"""
+	signer = Signer()
+	txs = []
+	for account_index in range(size):
+		leaf_keys = [derivation_cache.subkey_for_path(key, '%d/0/0' % account_index) for key in master_keys]
+		redeem_script = ScriptMultisig(2, sorted(key.sec() for key in leaf_keys))
+		p2sh_script = ScriptPayToScript(hash160(redeem_script.script())).script()
+		spendable = Spendable(100000 + account_index, p2sh_script, hashlib.sha256('bench %d' % account_index).digest(), 0)
+		tx = BatchableTx(1, [spendable.tx_in()], [TxOut(90000 + account_index, p2sh_script)], 0, [spendable])
+		tx.input_paths, tx.output_paths = ['/%d/0/0' % account_index], ['/%d/0/0' % account_index]
+		txs.append(signer.sign(tx, keys=leaf_keys[:1], redeem_scripts=[redeem_script]))
+	return txs
+
+
+def signed_pool(size):
+	xpubs = get_test_master_xpub_strings()[1:]
+	if os.path.exists(SIGNED_POOL_FILE):
+		pool = Batch.from_file(SIGNED_POOL_FILE)
+		if pool.original_master_xpubs == xpubs and len(pool.batchable_txs) >= size:
+			return pool.batchable_txs[:size]
+	print "[bench] Signing a pool of %d txs with the first key, kept in %s for next runs" % (size, SIGNED_POOL_FILE)
+	txs = build_signed_pool(size, get_test_master_keys()[1:])
+	if not os.path.exists(os.path.dirname(SIGNED_POOL_FILE)):
+		os.makedirs(os.path.dirname(SIGNED_POOL_FILE))
+	with quiet():
+		Batch(xpubs, xpubs, txs).to_file(SIGNED_POOL_FILE)
+	return txs
+
+
+def synthetic_txs(pool, size):
+	""":returns size txs repeating the pool's txs, each spending a distinct made up output so all tx hashes differ"""
+	txs = []
+	for i in range(size):
+		template = pool[i % len(pool)]
+		previous_hash = hashlib.sha256('bench %d' % i).digest()  # same as the pool's for the first len(pool) txs
+		tx_in, unspent = template.txs_in[0], template.unspents[0]
+		tx = BatchableTx(1, [TxIn(previous_hash, 0, tx_in.script, tx_in.sequence)], template.txs_out, 0, [
+			Spendable(unspent.coin_value, unspent.script, previous_hash, 0),
+		])
+		tx.input_paths, tx.output_paths = template.input_paths, template.output_paths
+		txs.append(tx)
+	return txs
+
+
+def bench_derivation(benchmarks, accounts, leafs):
+	branch = Branch(get_test_master_xpub_keys()[1:], account_template=Branch.bip32_account, provider=None)
+
+	def fresh_accounts():
+		derivation_cache.clear()
+		return [branch.account(account_index) for account_index in range(accounts)]
+
+	def addresses(accounts):
+		for account in accounts:
+			for leaf_n in range(leafs):
+				account.address(leaf_n, change=False)
+
+	benchmarks.time('branch.account/%d' % accounts, accounts, lambda args: [branch.account(i) for i in range(accounts)], setup=derivation_cache.clear)
+	benchmarks.time('account.address/%d' % (accounts * leafs), accounts * leafs, addresses, setup=fresh_accounts)
+
+
+def bench_sign(benchmarks, pool, workers):
+	xpubs = get_test_master_xpub_strings()[1:]
+	backup_key = get_test_master_keys()[2]
+
+	def unsigned_batch():
+		derivation_cache.clear()
+		return Batch(xpubs, xpubs, [BatchableTx.from_dict(tx.as_dict()) for tx in pool])
+
+	def sign(batch):
+		batch.sign(backup_key, workers=workers)
+		assert not any(tx.bad_signature_count() for tx in batch.batchable_txs), 'benchmark txs did not get signed'
+
+	benchmarks.time('batch.sign/%d' % len(pool), len(pool), sign, setup=unsigned_batch)
+
+
+def bench_batch(benchmarks, pool, size, directory):
+	xpubs = get_test_master_xpub_strings()[1:]
+	txs = synthetic_txs(pool, size)
+	batch = Batch(xpubs, xpubs, txs)
+	tx_dicts = [tx.as_dict() for tx in txs]
+	path = os.path.join(directory, 'bench-%d.txs' % size)
+
+	def drop_merkle_tree():
+		batch.merkle_tree = None
+
+	benchmarks.time('batch.build_merkle_root/%d' % size, size, lambda args: batch.build_merkle_root(), setup=drop_merkle_tree)
+	benchmarks.time('tx.as_dict/%d' % size, size, lambda args: [tx.as_dict() for tx in txs])
+	benchmarks.time('tx.from_dict/%d' % size, size, lambda args: [BatchableTx.from_dict(tx_dict) for tx_dict in tx_dicts])
+	benchmarks.time('batch.to_file/%d' % size, size, lambda args: batch.to_file(path))
+	benchmarks.time('batch.from_file/%d' % size, size, lambda args: Batch.from_file(path))
+
+
+def bench_snapshot(benchmarks, size, directory):
+	"""utxo snapshot store of size unspents on size / 2 addresses, looked up by as many addresses, half of them unused"""
+	addresses = [hash160_sec_to_bitcoin_address(hashlib.sha256('bench address %d' % i).digest()[:20], address_prefix=b'\5') for i in range(size)]
+	export_path = os.path.join(directory, 'utxos-%d.csv' % size)
+	with open(export_path, 'w') as fp:
+		for i in range(size):
+			fp.write('%s,%s,%d,%d\n' % (addresses[i // 2], b2h_rev(hashlib.sha256('bench %d' % i).digest()), i % 2, 100000 + i))
+	cache_path = os.path.join(directory, 'utxo_snapshots')
+	snapshot = UtxoSnapshot.from_export(export_path, cache_path=cache_path)
+
+	benchmarks.time('snapshot.from_export/%d' % size, size, lambda args: UtxoSnapshot.from_export(export_path, cache_path=cache_path),
+		setup=lambda: shutil.rmtree(cache_path, ignore_errors=True))
+	benchmarks.time('snapshot.used_addresses/%d' % size, size, lambda args: snapshot.used_addresses(addresses))
+
+
+def compare(results, baseline, tolerance):
+	""":returns names of benchmarks slower than in baseline by more than tolerance, eg. 0.25 for 25%"""
+	regressions = []
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+		ratio = result['seconds'] / max(baseline[name]['seconds'], 10**-6)
+		regressed = ratio > 1 + tolerance
+		print "[bench] %-30s %6.2fx baseline%s" % (name, ratio, ' REGRESSION' if regressed else '')
+		if regressed:
+			regressions.append(name)
+	return regressions
+
+
+def test_bench(sizes=(1000, 10000, 100000), sign_size=100, accounts=100, leafs=10, workers=1, repeat=3, save_path=None, baseline_path=None, tolerance=0.25):
+	""":returns names of regressed benchmarks, empty without baseline"""
+	benchmarks = Benchmarks(repeat=repeat)
+	pool = signed_pool(sign_size)
+	directory = tempfile.mkdtemp()
+	try:
+		bench_derivation(benchmarks, accounts, leafs)
+		bench_sign(benchmarks, pool, workers)
+		for size in sizes:
+			bench_batch(benchmarks, pool, size, directory)
+			bench_snapshot(benchmarks, size, directory)
+	finally:
+		shutil.rmtree(directory)
+
+	report = {
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'platform': platform.platform(),
+		'repeat': repeat, 'workers': workers, 'results': benchmarks.results,
+	}
+	if save_path:
+		with open(save_path, 'w') as fp:
+			json.dump(report, fp, indent=1)
+		print "[bench] Results saved to %s" % save_path
+	if not baseline_path:
+		return []
+	with open(baseline_path) as fp:
+		baseline = json.load(fp)
+	regressions = compare(benchmarks.results, baseline['results'], tolerance)
+	print "[bench] %d regressions against %s" % (len(regressions), baseline_path) if regressions else "[bench] OK"
+	return regressions
@@ -0,0 +1,311 @@
+#!/usr/bin/python2.7
+
+# End-to-end load test of every recovery command against an in-process fake insight node, no node or coins needed.
+# The fake node serves a deterministic synthetic history of the test branch: used accounts with gaps shorter than the
+# account gap, used leafs with gaps shorter than the leaf gap, and unspent outputs funded by made up txs. Address history
+# is served over http as insight's /api/addrs/txs, some addresses with pages of it. Every request to the fake node waits
+# the configured latency +- jitter and fails with IOError (http 503) at the configured rate per method.
+# Reports wall time, throughput and the latency percentiles of node requests for each command, and exits with status 1
+# if a command failed.
+
+# usage:
+# ./test load --accounts 1000 --latency 50 --jitter 20 --errors send_tx=0.05 --save load.json
+# ./test load --accounts 1000 --latency 50 --snapshot     (create scans a utxo snapshot of the history and known accounts)
+
+from . import get_test_hex_seeds, get_test_master_xpub_strings
+from .test_bench import quiet
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multisigcore.providers import insight
+from multisigrecovery import commands
+from multisigrecovery.batchfile import load_batch
+from multisigrecovery.branch import AccountPubkeys, Branch
+from pycoin.encoding import a2b_hashed_base58
+from pycoin.serialize import b2h_rev
+from pycoin.tx import Tx, TxIn, TxOut, Spendable
+from pycoin.tx.pay_to import ScriptPayToScript
+import argparse
+import collections
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+import urlparse
+
+
+class SyntheticWallet(object):
+	"""
+	Deterministic history of a branch. Used accounts are separated by runs of unused accounts shorter than account_gap,
+	used leafs of each chain by less than leaf_gap. A used leaf holds 1 to utxos unspent outputs, or none at spent_rate.
+	Used addresses have 1 to 3 txs of history, at busy_rate up to busy txs.
+	"""
+
+	def __init__(self, branch, accounts=100, leafs=3, utxos=2, gap_rate=0.2, spent_rate=0.1, account_gap=5, leaf_gap=5, busy_rate=0.1, busy=500, seed=0):
+		generator = random.Random(seed)
+		history_generator = random.Random('history %d' % seed)  # keeps the accounts and unspents of a seed as they were
+		self.funding_txs = {}
+		self.spendables_by_address = collections.defaultdict(list)
+		self.used = set()
+		self.history = {}  # address: txs
+		self.used_leafs = collections.OrderedDict()  # account index: (external leafs, internal leafs)
+		account_index = 0
+		while len(self.used_leafs) < accounts:
+			if account_index and generator.random() < gap_rate:
+				account_index += generator.randint(1, account_gap - 1)
+			account = branch.account(account_index)
+			chains = []
+			for chain, count in ((0, generator.randint(1, leafs)), (1, generator.randint(0, leafs))):
+				leaf_n, chain_leafs = -1, []
+				for i in range(count):
+					leaf_n += generator.randint(1, leaf_gap - 1)
+					chain_leafs.append(leaf_n)
+					address = account.address(leaf_n, change=bool(chain))
+					self.used.add(address)
+					self.history[address] = history_generator.randint(4, busy) if history_generator.random() < busy_rate else history_generator.randint(1, 3)
+					if generator.random() >= spent_rate:
+						for j in range(generator.randint(1, utxos)):
+							self.__fund(address, generator.randint(10000, 5000000))
+				chains.append(chain_leafs)
+			self.used_leafs[account_index] = tuple(chains)
+			account_index += 1
+
+	def __fund(self, address, coin_value):
+		script = ScriptPayToScript(a2b_hashed_base58(address)[1:]).script()
+		funding_tx = Tx(1, [TxIn(hashlib.sha256('funding %d' % len(self.funding_txs)).digest(), 0)], [TxOut(coin_value, script)], 0)
+		self.funding_txs[funding_tx.hash()] = funding_tx
+		self.spendables_by_address[address].append(Spendable(coin_value, script, funding_tx.hash(), 0))
+
+	def history_page(self, addresses, start, end):
+		""":returns (txs, items start to end) of the combined history of addresses, their txs interleaved"""
+		counts = [(address, self.history[address]) for address in addresses if address in self.history]
+		txs = (address for n in xrange(max([0] + [count for address, count in counts])) for address, count in counts if n < count)
+		items = [{'vin': [], 'vout': [{'scriptPubKey': {'addresses': [address]}}]} for address in itertools.islice(txs, start, end)]
+		return sum(count for address, count in counts), items
+
+	def save_utxo_snapshot(self, path):
+		"""writes the unspents as a node's utxo set export would, see multisigrecovery/snapshot.py"""
+		with open(path, 'w') as fp:
+			fp.write('address,txid,vout,value\n')
+			for address, spendables in sorted(self.spendables_by_address.items()):
+				for spendable in spendables:
+					fp.write('%s,%s,%d,%d\n' % (address, b2h_rev(spendable.tx_hash), spendable.tx_out_index, spendable.coin_value))
+
+	def save_known_accounts(self, path):
+		with open(path, 'w') as fp:
+			json.dump(dict((str(account_index), {'external_leafs': leafs[0], 'internal_leafs': leafs[1]}) for account_index, leafs in self.used_leafs.items()), fp)
+
+
+class FakeInsight(object):
+	"""
+	In-process stand-in for InsightBatchService serving a SyntheticWallet. Sent txs stay in mempool. Each request waits
+	latency +- jitter seconds and fails at the rate in errors for its method, eg. {'send_tx': 0.05}. Between start() and
+	stop() address history is served over http at base_url, as addrs_txs.
+	"""
+
+	base_url = 'http://fake-insight/'
+
+	def __init__(self, wallet, latency=0.0, jitter=0.0, errors=None, seed=0):
+		self.wallet = wallet
+		self.latency, self.jitter = latency, jitter
+		self.errors = errors or {}
+		self.random = random.Random(seed)
+		self.mempool = {}
+		self.latencies = collections.defaultdict(list)
+		self.lock = threading.Lock()
+		self.server = None
+
+	def start(self):
+		self.server = FakeInsightServer(self)
+		threading.Thread(target=self.server.serve_forever).start()
+		self.base_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def __getstate__(self):  # cached accounts are pickled with their provider, recovery reconnects them to the live one
+		return {}
+
+	def __request(self, method, answer, *args):
+		started = timeit.default_timer()
+		with self.lock:
+			delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+			failed = self.random.random() < self.errors.get(method, 0.0)
+		try:
+			time.sleep(delay)
+			if failed:
+				raise IOError('injected %s failure' % method)
+			return answer(*args)
+		finally:
+			with self.lock:
+				self.latencies[method].append(timeit.default_timer() - started)
+
+	def take_latencies(self):
+		""":returns {method: [seconds, ...]} of requests since the last call"""
+		with self.lock:
+			latencies, self.latencies = self.latencies, collections.defaultdict(list)
+		return latencies
+
+	def get_blockchain_tip(self):
+		return self.__request('get_blockchain_tip', lambda: {'height': 400000, 'blockhash': '00' * 32})
+
+	def get_tx(self, tx_hash):
+		return self.__request('get_tx', lambda: self.wallet.funding_txs.get(tx_hash) or self.mempool.get(tx_hash))
+
+	def send_tx(self, tx):
+		def accept():
+			with self.lock:
+				if tx.hash() in self.mempool:
+					raise ValueError('txn-already-in-mempool')
+				self.mempool[tx.hash()] = tx
+		return self.__request('send_tx', accept)
+
+	def spendables_for_address(self, address):
+		return self.spendables_for_addresses([address])
+
+	def spendables_for_addresses(self, addresses):
+		return self.__request('spendables_for_addresses', lambda: [spendable for address in addresses for spendable in self.wallet.spendables_by_address.get(address, [])])
+
+	def balance_for_addresses(self, addresses):
+		return sum(spendable.coin_value for spendable in self.spendables_for_addresses(addresses))
+
+	def addrs_txs(self, addresses, start, end):
+		""":returns /api/addrs/txs page"""
+		total, items = self.__request('addrs_txs', self.wallet.history_page, addresses, start, end)
+		return {'totalItems': total, 'from': start, 'to': start + len(items), 'items': items}
+
+
+class FakeInsightServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, insight):
+		HTTPServer.__init__(self, ('127.0.0.1', 0), FakeInsightHandler)
+		self.insight = insight
+
+
+class FakeInsightHandler(BaseHTTPRequestHandler):
+
+	def do_POST(self):
+		form = urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+		if self.path.rstrip('/') != '/api/addrs/txs':
+			self.send_response(404)
+			self.end_headers()
+			return
+		try:
+			body = json.dumps(self.server.insight.addrs_txs(form['addrs'][0].split(','), int(form['from'][0]), int(form['to'][0])))
+		except IOError:
+			self.send_response(503)
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+def percentile(values, fraction):
+	""":returns nearest-rank percentile of values, eg. fraction 0.99 for p99"""
+	ordered = sorted(values)
+	return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def command_args(**overrides):
+	""":returns namespace like ./recovery's argument parser would, with defaults of ./recovery"""
+	args = dict(
+		load=None, save=None, origin=None, destination=None, accounts=None, insight=FakeInsight.base_url, origin_template='bip32',
+		destination_template='bip32', private=None, register=None, path=None, format='json', shards=None, workers=1,
+		fee_rate=None, pack=1, connections=None, rate=None, utxo_snapshot=None,
+	)
+	args.update(overrides)
+	return argparse.Namespace(**args)
+
+
+def run_command(provider, command, items, **overrides):
+	""":returns wall time, throughput and node request latency percentiles of one command"""
+	provider.take_latencies()
+	error = None
+	started = timeit.default_timer()
+	try:
+		with quiet():
+			getattr(commands, command)(command_args(**overrides))
+	except Exception as err:
+		error = '%s: %s' % (err.__class__.__name__, err)
+	seconds = timeit.default_timer() - started
+	requests = collections.OrderedDict()
+	for method, latencies in sorted(provider.take_latencies().items()):
+		requests[method] = {'count': len(latencies), 'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+			'p90_ms': round(percentile(latencies, 0.9) * 1000, 2), 'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+	result = {'items': items, 'seconds': round(seconds, 4), 'items_per_second': round(items / seconds, 2), 'requests': requests, 'error': error}
+	print "[load] %-9s %8d items %10.2fs %10.2f/s%s" % (command, items, seconds, items / seconds, ' ! ' + error if error else '')
+	for method, stats in requests.items():
+		print "[load]     %-25s %7d requests  p50 %8.2fms  p90 %8.2fms  p99 %8.2fms" % (method, stats['count'], stats['p50_ms'], stats['p90_ms'], stats['p99_ms'])
+	return result
+
+
+def test_load(accounts=100, leafs=3, utxos=2, gap_rate=0.2, latency=0.0, jitter=0.0, errors=None, known_accounts=False, utxo_snapshot=False, workers=1, seed=0, save_path=None):
+	""":param latency, jitter: seconds, :param errors: {method: failure rate} :returns names of failed commands"""
+	seeds, xpubs = get_test_hex_seeds(), get_test_master_xpub_strings()
+	origin = destination = '%s,%s,%s' % (seeds[1], xpubs[2], xpubs[3])
+	branch = Branch([AccountPubkeys.parse_string_to_account_key_source(string) for string in origin.split(',')], account_template=Branch.bip32_account, provider=None)
+	print "[load] Generating history of %d accounts" % accounts
+	wallet = SyntheticWallet(branch, accounts=accounts, leafs=leafs, utxos=utxos, gap_rate=gap_rate, seed=seed)
+	provider = FakeInsight(wallet, latency=latency, jitter=jitter, errors=errors, seed=seed)
+	print "[load] %d accounts up to #%d, %d used addresses, %d unspents" % (len(wallet.used_leafs), next(reversed(wallet.used_leafs)), len(wallet.used), len(wallet.funding_txs))
+
+	provider.start()
+	directory, cwd = tempfile.mkdtemp(), os.getcwd()
+	insight_service = insight.InsightBatchService
+	insight.InsightBatchService = lambda url: provider  # commands import it when they run
+	os.chdir(directory)  # recovery caches live in ./cache
+	results = collections.OrderedDict()
+	try:
+		if known_accounts or utxo_snapshot:  # a snapshot can't tell spent addresses from unused ones
+			wallet.save_known_accounts('known-accounts.json')
+		if utxo_snapshot:
+			wallet.save_utxo_snapshot('utxos.csv')
+		results['address'] = run_command(provider, 'address', 1, origin=origin, path='0/0/0')
+		results['create'] = run_command(provider, 'create', len(wallet.used_leafs), origin=origin, destination=destination, save='batch.txs',
+			accounts='known-accounts.json' if known_accounts or utxo_snapshot else None, utxo_snapshot='utxos.csv' if utxo_snapshot else None, workers=workers)
+		txs = len(load_batch('batch.txs').batchable_txs) if os.path.exists('batch.txs') else 0
+		results['resume'] = run_command(provider, 'create', txs, origin=origin, destination=destination, save='resumed.txs',  # all txs cached, like a rerun after a crash in export
+			accounts='known-accounts.json' if known_accounts or utxo_snapshot else None, utxo_snapshot='utxos.csv' if utxo_snapshot else None, workers=workers)
+		if txs and not results['resume']['error'] and (not os.path.exists('resumed.txs') or load_batch('resumed.txs').merkle_root != load_batch('batch.txs').merkle_root):
+			results['resume']['error'] = 'create resumed from cache did not export the batch'
+		results['validate'] = run_command(provider, 'validate', txs, load='batch.txs', workers=workers)
+		results['cosign'] = run_command(provider, 'cosign', txs, load='batch.txs', private=seeds[2], save='signed.txs', workers=workers)
+		results['convert'] = run_command(provider, 'convert', txs, load='signed.txs', save='signed.pack', format='packed')
+		results['proofs'] = run_command(provider, 'proofs', txs, load='signed.txs', save='proofs.jsonl')
+		results['split'] = run_command(provider, 'split', txs, load='batch.txs', save='shards', shards=4)
+		results['join'] = run_command(provider, 'join', txs, load='shards.manifest.json', save='joined.txs')
+		results['broadcast'] = run_command(provider, 'broadcast', txs, load='signed.txs')
+		results['txcache'] = run_command(provider, 'txcache', len(wallet.funding_txs), save='txs.pack')
+	finally:
+		os.chdir(cwd)
+		insight.InsightBatchService = insight_service
+		provider.stop()
+		shutil.rmtree(directory)
+
+	print "[load] %d of %d txs in mempool" % (len(provider.mempool), txs)
+	if save_path:
+		report = {
+			'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'accounts': accounts, 'leafs': leafs, 'utxos': utxos, 'gap_rate': gap_rate,
+			'latency': latency, 'jitter': jitter, 'errors': errors or {}, 'known_accounts': known_accounts, 'utxo_snapshot': utxo_snapshot,
+			'workers': workers, 'seed': seed, 'results': results,
+		}
+		with open(save_path, 'w') as fp:
+			json.dump(report, fp, indent=1)
+		print "[load] Results saved to %s" % save_path
+	failures = [command for command, result in results.items() if result['error']]
+	print "[load] %d failures: %s" % (len(failures), ', '.join(failures)) if failures else "[load] OK"
+	return failures
@@ -0,0 +1,104 @@
+#!/usr/bin/python2.7
+
+# Fetching oracle keys against a local stand-in for the CryptoCorp oracle API, no network or oracle account needed.
+# The stand-in answers GET keychains/<id> with {"keys": {"default": [xpub]}}, fails the first request with 503 to
+# exercise retries and delays requests to /slow/ to exercise timeouts.
+
+# usage:
+# ./test oracle
+
+from . import get_test_master_keys
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from multisigrecovery.branch import Branch, OracleAccountPubkeys
+from multisigrecovery.oracleclient import PooledRequests
+import json
+import multisigcore.oracle
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
+
+
+class StandInOracle(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, oracle_xpub):
+		HTTPServer.__init__(self, ('127.0.0.1', 0), StandInOracleHandler)
+		self.oracle_xpub = oracle_xpub
+		self.requests = []
+		self.lock = threading.Lock()
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class StandInOracleHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		with self.server.lock:
+			self.server.requests.append(self.path)
+			first = len(self.server.requests) == 1
+		if self.path.startswith('/slow/'):
+			time.sleep(2)
+		if first:
+			self.send_response(503)
+			self.end_headers()
+			return
+		body = json.dumps({'keys': {'default': [self.server.oracle_xpub]}})
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+def test_oracle():
+	master_keys = get_test_master_keys()
+	server = StandInOracle(master_keys[3].bip32_account(0).hwif())
+	threading.Thread(target=server.serve_forever).start()
+	directory = tempfile.mkdtemp()
+	key_cache_path = os.path.join(directory, 'oracle_keys.jsonl')
+	try:
+		print "[test] Prefetching oracle keys of 20 accounts"
+		oracle = OracleAccountPubkeys(server.url, timeout=1, retries=2, key_cache_path=key_cache_path)
+		branch = Branch([master_keys[0], master_keys[1], oracle], account_template=Branch.bip32_account, provider=None)
+		branch.prefetch_oracle_keys(range(20), workers=5)
+		assert len(server.requests) == 21, server.requests  # one retried after 503
+		assert len(set(server.requests)) == 20
+
+		print "[test] Oracle keys are served from disk cache in the next run"
+		oracle = OracleAccountPubkeys(server.url, key_cache_path=key_cache_path)
+		branch = Branch([master_keys[0], master_keys[1], oracle], account_template=Branch.bip32_account, provider=None)
+		assert branch.account(7).keys[-1].hwif() == server.oracle_xpub
+		assert len(server.requests) == 21
+
+		print "[test] Each oracle key source keeps its own client"
+		fast = OracleAccountPubkeys(server.url + 'slow/', timeout=0.5, retries=0, key_cache_path=key_cache_path)
+		slow = OracleAccountPubkeys(server.url + 'slow/', timeout=5, retries=0, key_cache_path=key_cache_path)
+		try:
+			Branch([master_keys[0], master_keys[1], fast], account_template=Branch.bip32_account, provider=None).account(30)
+			raise AssertionError('oracle request did not time out')
+		except requests.exceptions.RequestException:
+			pass
+		assert Branch([master_keys[0], master_keys[1], slow], account_template=Branch.bip32_account, provider=None).account(30).keys[-1].hwif() == server.oracle_xpub
+		assert multisigcore.oracle.requests is requests
+
+		print "[test] Slow responses time out"
+		started = time.time()
+		try:
+			PooledRequests(timeout=0.5, retries=0).get(server.url + 'slow/')
+			raise AssertionError('request did not time out')
+		except requests.exceptions.RequestException:
+			pass
+		assert time.time() - started < 1.5
+		print "[test] OK"
+	finally:
+		server.shutdown()
+		shutil.rmtree(directory)
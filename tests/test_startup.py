@@ -0,0 +1,117 @@
+#!/usr/bin/python2.7
+
+# Cold start of the offline commands: runs ./recovery address and ./recovery cosign of a one tx batch as fresh
+# processes and reports the median wall time of each, next to the bare interpreter start. A run of each command also
+# records the modules it loaded and fails if a network module (requests, the oracle or insight clients, ...) is among
+# them, so a top-level import can't quietly bring them back. Results compare against a baseline like ./test bench.
+
+# usage:
+# ./test startup --save startup.json
+# ./test startup --baseline startup.json --repeat 20
+
+from . import get_test_hex_seeds, get_test_master_keys, get_test_master_xpub_strings
+from .test_bench import build_signed_pool, compare, quiet
+from multisigrecovery.batch import Batch
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+RECOVERY_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'recovery')
+NETWORK_MODULES = [
+	'requests', 'multisigcore.oracle', 'multisigcore.providers.insight', 'pycoin.services',
+	'multisigrecovery.recovery', 'multisigrecovery.broadcast', 'multisigrecovery.oracleclient',
+]
+
+# runs ./recovery in this process and dumps the names of loaded modules to the file in argv[1]
+MODULES_WRAPPER = """
+import json, sys
+modules_path, sys.argv = sys.argv[1], sys.argv[2:]
+try:
+	execfile(sys.argv[0], {'__name__': '__main__'})
+finally:
+	with open(modules_path, 'w') as fp:
+		json.dump(sorted(name for name, module in sys.modules.items() if module is not None), fp)
+"""
+
+
+def run(command, directory):
+	""":returns wall time of command, a list of process arguments, run in directory"""
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(RECOVERY_SCRIPT), os.environ.get('PYTHONPATH')])))
+	started = timeit.default_timer()
+	process = subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stdout, stderr = process.communicate()
+	seconds = timeit.default_timer() - started
+	if process.returncode or 'Error' in stderr:
+		raise AssertionError('%s failed:\n%s%s' % (' '.join(command), stdout, stderr))
+	return seconds
+
+
+def loaded_modules(arguments, directory):
+	""":returns names of modules loaded by a ./recovery run"""
+	modules_path = os.path.join(directory, '_modules.json')
+	run([sys.executable, '-c', MODULES_WRAPPER, modules_path, RECOVERY_SCRIPT] + arguments, directory)
+	with open(modules_path) as fp:
+		return json.load(fp)
+
+
+def median(values):
+	ordered = sorted(values)
+	middle = len(ordered) // 2
+	return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def test_startup(repeat=10, save_path=None, baseline_path=None, tolerance=0.25):
+	""":returns names of regressed or network loading commands, regressions empty without baseline"""
+	seeds, xpubs = get_test_hex_seeds(), get_test_master_xpub_strings()
+	directory = tempfile.mkdtemp()
+	try:
+		with quiet():
+			Batch(xpubs[1:], xpubs[1:], build_signed_pool(1, get_test_master_keys()[1:])).to_file(os.path.join(directory, 'batch.txs'))
+		commands = collections.OrderedDict([
+			('python', None),
+			('address', ['address', '--origin', '%s,%s,%s' % (seeds[1], xpubs[2], xpubs[3]), '--path', '0/0/0']),
+			('cosign', ['cosign', '--load', 'batch.txs', '--private', seeds[2], '--save', 'signed.txs']),
+		])
+
+		failures = []
+		for name, arguments in commands.items():
+			if arguments is None:
+				continue
+			network_modules = [module for module in loaded_modules(arguments, directory)
+				if any(module == network_module or module.startswith(network_module + '.') for network_module in NETWORK_MODULES)]
+			if network_modules:
+				print "[startup] %-9s loads network modules: %s" % (name, ', '.join(network_modules))
+				failures.append(name)
+
+		results = collections.OrderedDict()
+		for name, arguments in commands.items():
+			command = [sys.executable, '-c', 'pass'] if arguments is None else [sys.executable, RECOVERY_SCRIPT] + arguments
+			timings = [run(command, directory) for i in range(repeat)]
+			seconds = median(timings)
+			results[name] = {'items': 1, 'seconds': round(seconds, 6), 'min_seconds': round(min(timings), 6), 'max_seconds': round(max(timings), 6)}
+			print "[startup] %-9s median %8.1fms  min %8.1fms  max %8.1fms" % (name, seconds * 1000, min(timings) * 1000, max(timings) * 1000)
+	finally:
+		shutil.rmtree(directory)
+
+	report = {
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'platform': platform.platform(),
+		'repeat': repeat, 'results': results,
+	}
+	if save_path:
+		with open(save_path, 'w') as fp:
+			json.dump(report, fp, indent=1)
+		print "[startup] Results saved to %s" % save_path
+	regressions = []
+	if baseline_path:
+		with open(baseline_path) as fp:
+			baseline = json.load(fp)
+		regressions = compare(results, baseline['results'], tolerance)
+	print "[startup] %d failures: %s" % (len(failures + regressions), ', '.join(failures + regressions)) if failures or regressions else "[startup] OK"
+	return failures + regressions